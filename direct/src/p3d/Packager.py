@@ -10,10 +10,16 @@ import sys
 import os
 import glob
 import marshal
+import operator
 import string
 import types
 import getpass
+import fnmatch
+import cStringIO
+import hashlib
+import mmap
 import platform
+import re
 import struct
 import subprocess
 from direct.p3d.FileSpec import FileSpec
@@ -34,10 +40,287 @@ class OutsideOfPackageError(PackagerError):
 class ArgumentError(PackagerError):
     pass
 
+def internString(value):
+    """ Returns the interned copy of the indicated string, so that the
+    many repeated package names, platforms, versions and filename
+    extensions share a single string object.  Values other than str,
+    such as None, are returned unchanged. """
+    if isinstance(value, types.StringType):
+        return intern(value)
+    return value
+
+def hashFile(pathname):
+    """ Returns the MD5 hash of the indicated file, as a hex string in
+    the same form as HashVal.asHex().  The file is mapped into memory
+    and hashed with hashlib in one call, which runs without holding
+    the Python interpreter lock.  Files that aren't on the real file
+    system are hashed with HashVal, which reads through the vfs. """
+
+    md5 = hashlib.md5()
+    try:
+        f = open(pathname.toOsSpecific(), 'rb')
+        try:
+            if os.fstat(f.fileno()).st_size:
+                # An empty file can't be mapped.
+                data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+                try:
+                    md5.update(data)
+                finally:
+                    data.close()
+        finally:
+            f.close()
+    except EnvironmentError:
+        # Not a real file, or too big to map in our address space.
+        hv = HashVal()
+        hv.hashFile(pathname)
+        return hv.asHex()
+
+    return md5.hexdigest()
+
+# The regular expressions returned by globsToRegex(), keyed on the
+# tuple of patterns.  Every Packager starts out with the same list of
+# excluded system globs, so it need only be compiled once.
+globRegexes = {}
+
+def globsToRegex(patterns):
+    """ Returns a compiled regular expression that matches, in one
+    call, any string matched by one of the indicated glob pattern
+    strings, or None if the list is empty. """
+
+    if not patterns:
+        return None
+
+    key = tuple(patterns)
+    regex = globRegexes.get(key, None)
+    if regex is None:
+        regex = globRegexes[key] = compileGlobs(patterns)
+    return regex
+
+def compileGlobs(patterns):
+    """ The implementation of globsToRegex(), above. """
+
+    regexes = []
+    for pattern in patterns:
+        regex = fnmatch.translate(pattern)
+        # Strip off the end anchor and flags that translate() adds,
+        # so the patterns can be joined; they're added back below.
+        if regex.endswith('\\Z(?ms)'):
+            regex = regex[:-7]
+        elif regex.startswith('(?s:') and regex.endswith(')\\Z'):
+            regex = regex[4:-3]
+        regexes.append('(?:%s)' % (regex))
+
+    return re.compile('(?:%s)\\Z' % ('|'.join(regexes)), re.DOTALL)
+
+# The entities used by xmlEscape() for the markup characters.  As in
+# TinyXML, all other control characters, including whitespace such as
+# newlines, are written as character references too, or an XML parser
+# would read each of them back as a space.
+xmlEscapeEntities = {
+    '&' : '&amp;',
+    '<' : '&lt;',
+    '>' : '&gt;',
+    '"' : '&quot;',
+    "'" : '&apos;',
+    }
+xmlEscapeRegex = re.compile('[&<>"\'\x00-\x1f]')
+
+def xmlEscape(value):
+    """ Returns the indicated string with the characters that have
+    special meaning within an XML attribute value replaced by their
+    corresponding entities. """
+    return xmlEscapeRegex.sub(xmlEscapeChar, value)
+
+def xmlEscapeChar(match):
+    """ The implementation of xmlEscape(), above. """
+    ch = match.group()
+    entity = xmlEscapeEntities.get(ch)
+    if entity is None:
+        entity = '&#x%02X;' % (ord(ch))
+    return entity
+
+class XmlAttributes:
+    """ Collects attributes through the same SetAttribute() interface
+    offered by TiXmlElement, so that FileSpec and SeqValue can store
+    themselves into it, and then writes them out directly as text,
+    without building a DOM tree. """
+
+    def __init__(self):
+        self.attributes = []
+
+    def SetAttribute(self, name, value):
+        self.attributes.append((name, value))
+
+    def write(self, out):
+        """ Writes the attributes, each preceded by a space, to the
+        indicated file-like object. """
+        for name, value in self.attributes:
+            out.write(' %s="%s"' % (name, xmlEscape(value)))
+
+class XmlNode(XmlAttributes):
+    """ A lightweight stand-in for TiXmlElement, providing just the
+    methods the packager uses to build its output files.  The tree is
+    written out directly as text, in the same layout TinyXML uses, so
+    the files can be produced without building a TiXmlDocument. """
+
+    def __init__(self, value):
+        XmlAttributes.__init__(self)
+        self.value = value
+        self.children = []
+
+    def SetValue(self, value):
+        self.value = value
+
+    def SetAttribute(self, name, value):
+        # As in TinyXML, setting an existing attribute replaces it.
+        for i in range(len(self.attributes)):
+            if self.attributes[i][0] == name:
+                self.attributes[i] = (name, value)
+                return
+        self.attributes.append((name, value))
+
+    def InsertEndChild(self, child):
+        self.children.append(child)
+
+    def writeXml(self, out, indent = ''):
+        """ Writes this element and its children to the indicated
+        file-like object. """
+        out.write('%s<%s' % (indent, self.value))
+        self.write(out)
+        if not self.children:
+            out.write(' />\n')
+            return
+
+        out.write('>\n')
+        for child in self.children:
+            child.writeXml(out, indent + '    ')
+        out.write('%s</%s>\n' % (indent, self.value))
+
+def writeXmlDocument(out, xelement):
+    """ Writes the XML declaration followed by the indicated XmlNode
+    tree to the indicated file-like object. """
+    out.write('<?xml version="1.0" encoding="utf-8" ?>\n')
+    xelement.writeXml(out)
+
+class XmlElement:
+    """ Wraps an ElementTree element in the subset of the TiXmlElement
+    interface used by the loadXml() methods, so that they can also be
+    fed from an incremental parse. """
+
+    def __init__(self, element, parent = None, index = 0):
+        self.element = element
+        self.parent = parent
+        self.index = index
+
+        # The list of child elements, filled in the first time it
+        # is needed, and shared by all of the children's wrappers.
+        self.children = None
+
+    def Attribute(self, name):
+        value = self.element.get(name)
+        if isinstance(value, types.UnicodeType):
+            value = value.encode('utf-8')
+        return value
+
+    def FirstChildElement(self, tag):
+        return self.__findChild(tag, 0)
+
+    def NextSiblingElement(self, tag):
+        if not self.parent:
+            return None
+        return self.parent.__findChild(tag, self.index + 1)
+
+    def Clone(self):
+        """ Returns a copy of this element and its children as an
+        XmlNode, which can be written out again later. """
+        return self.__makeNode(self.element)
+
+    def __findChild(self, tag, start):
+        if self.children is None:
+            self.children = list(self.element)
+        children = self.children
+        for i in range(start, len(children)):
+            if children[i].tag == tag:
+                return XmlElement(children[i], self, i)
+        return None
+
+    def __makeNode(self, element):
+        node = XmlNode(element.tag)
+        for name, value in element.items():
+            if isinstance(value, types.UnicodeType):
+                value = value.encode('utf-8')
+            node.attributes.append((name, value))
+        for child in element:
+            node.children.append(self.__makeNode(child))
+        return node
+
+def loadXmlFile(pathname):
+    """ Parses the indicated XML file with ElementTree, and returns
+    its root element wrapped in an XmlElement, or None if the file
+    could not be read or parsed. """
+
+    try:
+        from xml.etree import cElementTree as ElementTree
+    except ImportError:
+        from xml.etree import ElementTree
+
+    try:
+        tree = ElementTree.parse(pathname.toOsSpecific())
+    except (IOError, SyntaxError):
+        return None
+    return XmlElement(tree.getroot())
+
+def loadXmlRootAttributes(pathname, tag):
+    """ Reads only as far as the root element of the indicated XML
+    file, and returns a dictionary of its attributes, or None if the
+    file could not be read or its root element is not the indicated
+    tag. """
+
+    try:
+        from xml.etree import cElementTree as ElementTree
+    except ImportError:
+        from xml.etree import ElementTree
+
+    try:
+        f = open(pathname.toOsSpecific(), 'rb')
+        try:
+            for event, elem in ElementTree.iterparse(f, events = ('start', )):
+                if elem.tag != tag:
+                    return None
+                return dict(elem.attrib)
+        finally:
+            f.close()
+    except (IOError, SyntaxError):
+        pass
+    return None
+
 class Packager:
     notify = directNotify.newCategory("Packager")
 
-    class PackFile:
+    # The compiled code of each pdef file read so far in this
+    # session, shared by all Packager objects.  See
+    # __compilePackageDef().
+    pdefCodeCache = {}
+
+    # The functions made available to pdef files, keyed on the
+    # Packager class they were built for.  See __getPdefFunctions().
+    pdefFunctions = {}
+
+    # Splits a version string for __makeVersionTuple(), and the tuples
+    # it has already made, since the same versions come up repeatedly.
+    versionWordsRE = re.compile(r'([^0-9]*)([0-9]*)')
+    versionTuples = {}
+
+    class PackFile(object):
+        # There may be many thousands of these per package, so they
+        # are kept as small as possible.
+        __slots__ = ('filename', 'newName', 'deleteTemp', 'explicit',
+                     'compress', 'extract', 'text', 'unprocessed',
+                     'executable', 'dependencyDir', 'platformSpecific',
+                     'required', 'extension', 'basename',
+                     'excludeBasename', 'excluded', 'excludedPackage',
+                     'excludedSeq', 'dcStripped')
+
         def __init__(self, package, filename,
                      newName = None, deleteTemp = False,
                      explicit = False, compress = None, extract = None,
@@ -46,7 +329,6 @@ class Packager:
                      platformSpecific = None, required = False):
             assert isinstance(filename, Filename)
             self.filename = Filename(filename)
-            self.newName = newName
             self.deleteTemp = deleteTemp
             self.explicit = explicit
             self.compress = compress
@@ -58,26 +340,35 @@ class Packager:
             self.platformSpecific = platformSpecific
             self.required = required
 
-            if not self.newName:
-                self.newName = str(self.filename)
+            # Set by Package.__readDcFile() once self.text holds the
+            # stripped contents of this dc file.
+            self.dcStripped = False
 
-            ext = Filename(self.newName).getExtension()
-            if ext == 'pz':
+            packager = package.packager
+            self.setNewName(newName or str(self.filename), packager)
+
+            if self.extension == 'pz':
                 # Strip off a .pz extension; we can compress files
                 # within the Multifile without it.
                 filename = Filename(self.newName)
                 filename.setExtension('')
-                self.newName = str(filename)
-                ext = Filename(self.newName).getExtension()
+                self.setNewName(str(filename), packager)
                 if self.compress is None:
                     self.compress = True
 
-            packager = package.packager
+            ext = self.extension
+
+            # The result of isExcluded(), and the package and its
+            # excludeSeq value for which it was computed.
+            self.excluded = False
+            self.excludedPackage = None
+            self.excludedSeq = None
+
             if self.compress is None:
-                self.compress = (ext not in packager.uncompressibleExtensions and ext not in packager.imageExtensions)
+                self.compress = (ext not in packager.uncompressedExtensionsSet)
 
             if self.executable is None:
-                self.executable = (ext in packager.executableExtensions)
+                self.executable = (ext in packager.executableExtensionsSet)
 
             if self.executable and self.dependencyDir is None:
                 # By default, install executable dependencies in the
@@ -85,12 +376,12 @@ class Packager:
                 self.dependencyDir = ''
 
             if self.extract is None:
-                self.extract = self.executable or (ext in packager.extractExtensions)
+                self.extract = self.executable or (ext in packager.extractExtensionsSet)
             if self.platformSpecific is None:
-                self.platformSpecific = self.executable or (ext in packager.platformSpecificExtensions)
+                self.platformSpecific = self.executable or (ext in packager.platformSpecificExtensionsSet)
 
             if self.unprocessed is None:
-                self.unprocessed = self.executable or (ext in packager.unprocessedExtensions)
+                self.unprocessed = self.executable or (ext in packager.unprocessedExtensionsSet)
 
             if self.executable:
                 # Look up the filename along the system PATH, if necessary.
@@ -103,20 +394,56 @@ class Packager:
                     if packager.resolveLibrary(basename):
                         self.filename = basename
 
-            if ext in packager.textExtensions and not self.executable:
+            if ext in packager.textExtensionsSet and not self.executable:
                 self.filename.setText()
             else:
                 self.filename.setBinary()
 
             # Convert the filename to an unambiguous filename for
-            # searching.
-            self.filename.makeTrueCase()
-            if self.filename.exists() or not self.filename.isLocal():
+            # searching.  There's no point in asking the filesystem
+            # for the true case of a file that doesn't exist, or
+            # whose contents were supplied as text.
+            if self.filename.exists():
+                if not self.text:
+                    self.filename.makeTrueCase()
                 self.filename.makeCanonical()
+            elif not self.filename.isLocal():
+                self.filename.makeCanonical()
+
+        def setNewName(self, newName, packager):
+            """ Changes the name of the file within the package, and
+            recomputes the values derived from it: the extension and
+            basename, and the basename in the form in which it is
+            compared against the system exclude lists. """
+
+            self.newName = newName
+            filename = Filename(newName)
+            self.extension = internString(filename.getExtension())
+            self.basename = filename.getBasename()
+
+            self.excludeBasename = self.basename
+            if not packager.caseSensitive:
+                self.excludeBasename = self.excludeBasename.lower()
+
+            # The cached isExcluded() result is no longer valid.
+            self.excludedSeq = None
 
         def isExcluded(self, package):
             """ Returns true if this file should be excluded or
-            skipped, false otherwise. """
+            skipped, false otherwise.  The result is cached until the
+            file is checked against a different package, or the
+            package's exclusion rules change. """
+
+            if self.excludedPackage is not package or \
+               self.excludedSeq != package.excludeSeq:
+                self.excluded = self.__checkExcluded(package)
+                self.excludedPackage = package
+                self.excludedSeq = package.excludeSeq
+
+            return self.excluded
+
+        def __checkExcluded(self, package):
+            """ Does the actual work of isExcluded(). """
 
             if self.newName.lower() in package.skipFilenames:
                 return True
@@ -126,13 +453,14 @@ class Packager:
                 # files.  (But only make this check if this file was
                 # not explicitly added.)
 
-                basename = Filename(self.newName).getBasename()
-                if not package.packager.caseSensitive:
-                    basename = basename.lower()
-                if basename in package.packager.excludeSystemFiles:
+                packager = package.packager
+                if self.excludeBasename in packager.excludeSystemFilesSet:
                     return True
-                for exclude in package.packager.excludeSystemGlobs:
-                    if exclude.matches(basename):
+                if packager.excludeSystemGlobsRE and \
+                   packager.excludeSystemGlobsRE.match(self.excludeBasename):
+                    return True
+                for exclude in packager.excludeSystemGlobsWild:
+                    if exclude.matches(self.excludeBasename):
                         return True
 
                 # Also check if it was explicitly excluded.  As above,
@@ -157,23 +485,57 @@ class Packager:
             if not self.localOnly:
                 filename = Filename(filename)
                 filename.makeCanonical()
-            self.glob = GlobPattern(str(filename))
-
-            if self.packager.platform.startswith('win'):
-                self.glob.setCaseSensitive(False)
-            elif self.packager.platform.startswith('osx'):
-                self.glob.setCaseSensitive(False)
+            pattern = str(filename)
+            self.glob = GlobPattern(pattern)
+
+            # The packager has already determined whether the target
+            # file system is case-sensitive.
+            self.caseSensitive = caseSensitive
+            self.glob.setCaseSensitive(self.caseSensitive)
+
+            # Most patterns are either a plain filename or a simple
+            # suffix like "*.pyc".  These can be tested with a string
+            # comparison instead of the general glob matcher.
+            self.matchType = 'glob'
+            self.matchString = None
+            if '\\' not in pattern:
+                if not self.glob.hasGlobCharacters():
+                    self.matchType = 'literal'
+                    self.matchString = pattern
+                elif pattern.startswith('*') and \
+                     not GlobPattern(pattern[1:]).hasGlobCharacters():
+                    self.matchType = 'suffix'
+                    self.matchString = pattern[1:]
+
+            if self.matchString is not None and not self.caseSensitive:
+                self.matchString = self.matchString.lower()
 
         def matches(self, filename):
             if self.localOnly:
-                return self.glob.matches(filename.getBasename())
+                name = filename.getBasename()
             else:
-                return self.glob.matches(str(filename))
+                name = str(filename)
 
-    class PackageEntry:
+            if self.matchType == 'glob':
+                return self.glob.matches(name)
+
+            if not self.caseSensitive:
+                name = name.lower()
+            if self.matchType == 'suffix':
+                return name.endswith(self.matchString)
+            else:
+                return name == self.matchString
+
+    class PackageEntry(object):
         """ This corresponds to a <package> entry in the contents.xml
         file. """
 
+        # There is one of these for every package on the host, so
+        # they are kept as small as possible.
+        __slots__ = ('packageName', 'platform', 'version', 'solo',
+                     'perPlatform', 'packageSeq', 'packageSetVer',
+                     'descFile', 'importDescFile')
+
         def __init__(self):
             # The "seq" value increments automatically with each publish.
             self.packageSeq = SeqValue()
@@ -189,9 +551,9 @@ class Packager:
 
         def fromFile(self, packageName, platform, version, solo, perPlatform,
                      installDir, descFilename, importDescFilename):
-            self.packageName = packageName
-            self.platform = platform
-            self.version = version
+            self.packageName = internString(packageName)
+            self.platform = internString(platform)
+            self.version = internString(version)
             self.solo = solo
             self.perPlatform = perPlatform
 
@@ -204,9 +566,9 @@ class Packager:
                 self.importDescFile.fromFile(installDir, importDescFilename)
 
         def loadXml(self, xpackage):
-            self.packageName = xpackage.Attribute('name')
-            self.platform = xpackage.Attribute('platform')
-            self.version = xpackage.Attribute('version')
+            self.packageName = internString(xpackage.Attribute('name'))
+            self.platform = internString(xpackage.Attribute('platform'))
+            self.version = internString(xpackage.Attribute('version'))
             solo = xpackage.Attribute('solo')
             self.solo = int(solo or '0')
             perPlatform = xpackage.Attribute('per_platform')
@@ -252,6 +614,37 @@ class Packager:
 
             return xpackage
 
+        def writeXml(self, out, indent = '    '):
+            """ Writes the <package> element directly to the indicated
+            file-like object.  This produces the same output as
+            makeXml(), without building a TiXmlElement first. """
+            xpackage = XmlAttributes()
+            xpackage.SetAttribute('name', self.packageName)
+            if self.platform:
+                xpackage.SetAttribute('platform', self.platform)
+            if self.version:
+                xpackage.SetAttribute('version', self.version)
+            if self.solo:
+                xpackage.SetAttribute('solo', '1')
+            if self.perPlatform:
+                xpackage.SetAttribute('per_platform', '1')
+
+            self.packageSeq.storeXml(xpackage, 'seq')
+            self.packageSetVer.storeXml(xpackage, 'set_ver')
+            self.descFile.storeXml(xpackage)
+
+            out.write('%s<package' % (indent))
+            xpackage.write(out)
+
+            if self.importDescFile:
+                ximport = XmlAttributes()
+                self.importDescFile.storeXml(ximport)
+                out.write('>\n%s    <import' % (indent))
+                ximport.write(out)
+                out.write(' />\n%s</package>\n' % (indent))
+            else:
+                out.write(' />\n')
+
     class HostEntry:
         def __init__(self, url = None, downloadUrl = None,
                      descriptiveName = None, hostDir = None,
@@ -282,9 +675,10 @@ class Packager:
                 he.loadXml(xalthost, packager)
                 xalthost = xalthost.NextSiblingElement('alt_host')
 
-        def makeXml(self, packager = None):
-            """ Returns a new TiXmlElement. """
-            xhost = TiXmlElement('host')
+        def makeXml(self, packager = None, elementClass = TiXmlElement):
+            """ Returns a new TiXmlElement, or a new element of the
+            indicated class, such as XmlNode. """
+            xhost = elementClass('host')
             xhost.SetAttribute('url', self.url)
             if self.downloadUrl and self.downloadUrl != self.url:
                 xhost.SetAttribute('download_url', self.downloadUrl)
@@ -294,7 +688,7 @@ class Packager:
                 xhost.SetAttribute('host_dir', self.hostDir)
 
             for mirror in self.mirrors:
-                xmirror = TiXmlElement('mirror')
+                xmirror = elementClass('mirror')
                 xmirror.SetAttribute('url', mirror)
                 xhost.InsertEndChild(xmirror)
 
@@ -304,13 +698,52 @@ class Packager:
                 for keyword, alt in altHosts:
                     he = packager.hosts.get(alt, None)
                     if he:
-                        xalthost = he.makeXml()
+                        xalthost = he.makeXml(elementClass = elementClass)
                         xalthost.SetValue('alt_host')
                         xalthost.SetAttribute('keyword', keyword)
                         xhost.InsertEndChild(xalthost)
 
             return xhost
 
+        def writeXml(self, out, packager = None, indent = '    ',
+                     tag = 'host', keyword = None):
+            """ Writes the <host> element directly to the indicated
+            file-like object.  This produces the same output as
+            makeXml(), without building a TiXmlElement first. """
+            xhost = XmlAttributes()
+            xhost.SetAttribute('url', self.url)
+            if self.downloadUrl and self.downloadUrl != self.url:
+                xhost.SetAttribute('download_url', self.downloadUrl)
+            if self.descriptiveName:
+                xhost.SetAttribute('descriptive_name', self.descriptiveName)
+            if self.hostDir:
+                xhost.SetAttribute('host_dir', self.hostDir)
+            if keyword:
+                xhost.SetAttribute('keyword', keyword)
+
+            altHosts = []
+            if packager:
+                items = self.altHosts.items()
+                items.sort()
+                for altKeyword, alt in items:
+                    he = packager.hosts.get(alt, None)
+                    if he:
+                        altHosts.append((altKeyword, he))
+
+            out.write('%s<%s' % (indent, tag))
+            xhost.write(out)
+            if not self.mirrors and not altHosts:
+                out.write(' />\n')
+                return
+
+            out.write('>\n')
+            for mirror in self.mirrors:
+                out.write('%s    <mirror url="%s" />\n' % (indent, xmlEscape(mirror)))
+            for altKeyword, he in altHosts:
+                he.writeXml(out, indent = indent + '    ',
+                            tag = 'alt_host', keyword = altKeyword)
+            out.write('%s</%s>\n' % (indent, tag))
+
 
     class Package:
         """ This is the full information on a particular package we
@@ -318,8 +751,52 @@ class Packager:
         which contains only the information found in the toplevel
         contents.xml file."""
 
+        # Matches the list of dll's following the header line in the
+        # output of dumpbin /dependents; the list ends at a blank line.
+        dumpbinDependsRE = re.compile(r' has the following dependencies[^\n]*\n(?:[ \t\r]*\n)?((?:[ \t]*\S[^\n]*(?:\n|$))*)')
+
+        # Matches each indented dylib line in the output of otool -L,
+        # capturing the filename without the version information.
+        otoolDependsRE = re.compile(r'^[ \t]+(\S.*?)(?: \(compatibility|(?<=\.dylib))', re.MULTILINE)
+
+        # Matches each "name => path" line in the output of ldd,
+        # capturing the name on the left of the arrow.
+        lddDependsRE = re.compile(r'^[ \t]*(\S[^\n]*?)[ \t]* => ', re.MULTILINE)
+
+        # The Mach-O load commands that name a dylib this file
+        # depends on: LC_LOAD_DYLIB, LC_LOAD_WEAK_DYLIB,
+        # LC_REEXPORT_DYLIB, LC_LAZY_LOAD_DYLIB and
+        # LC_LOAD_UPWARD_DYLIB.
+        machODylibCommands = frozenset([0xc, 0x80000018, 0x8000001f, 0x20, 0x80000023])
+
+        # The Mach-O cputype for each OSX "arch" string.
+        machOCpuTypes = {
+            'i386' : 7,
+            'x86_64' : 0x01000007,
+            'ppc' : 18,
+            'ppc64' : 0x01000012,
+            'arm64' : 0x0100000c,
+            }
+
+        # Only OSX itself installs dylibs into these directories, so
+        # dependencies on them are never packaged.  Third-party
+        # libraries go under /usr/local instead.
+        osxSystemLibraryDirs = ('/usr/lib/', )
+
+        # The vDSO's provided by the Linux kernel, which aren't
+        # supposed to be anywhere on the system.
+        linuxVirtualLibraries = frozenset(['linux-gate.so.1', 'linux-vdso.so.1'])
+
+        # How each type of config value is written by __addConfigs();
+        # any other type is simply converted with str().  True or
+        # False must be encoded as 1 or 0.
+        configEncoders = {
+            types.UnicodeType : lambda value: value.encode('utf-8'),
+            types.BooleanType : lambda value: str(int(value)),
+            }
+
         def __init__(self, packageName, packager):
-            self.packageName = packageName
+            self.packageName = internString(packageName)
             self.packager = packager
             self.notify = packager.notify
 
@@ -361,12 +838,33 @@ class Packager:
             # the files that have been explicitly excluded.
             self.excludedFilenames = []
 
+            # This is incremented whenever the above lists change,
+            # to invalidate the PackFile.isExcluded() cache.
+            self.excludeSeq = 0
+
             # This is the list of files we will be adding, and a pair
-            # of cross references.
+            # of cross references, keyed on the source filename (as a
+            # string) and on the lowercase target name.
             self.files = []
             self.sourceFilenames = {}
             self.targetFilenames = {}
 
+            # This records, for each lowercase texture basename copied
+            # into importedMapsDir, the last uniqueId suffix handed
+            # out for it, so that addFoundTexture() need not probe
+            # every suffix again for a popular name.
+            self.importedMapIds = {}
+
+            # This maps each texture fullpath (as a string) passed to
+            # addFoundTexture() to the name it was given, so that a
+            # texture shared by many models is only looked up once.
+            self.foundTextures = {}
+
+            # The hashes of output files we have already hashed while
+            # writing this package, keyed on the pathname as a string,
+            # for getFileSpec().
+            self.knownHashes = {}
+
             # This is the set of files and modules that are
             # required and may not be excluded from the package.
             self.requiredFilenames = []
@@ -375,6 +873,7 @@ class Packager:
             # This records the current list of modules we have added so
             # far.
             self.freezer = FreezeTool.Freezer(platform = self.packager.platform)
+            self.freezer.multifileFlushBytes = self.packager.multifileFlushBytes
 
         def close(self):
             """ Writes out the contents of the current package.  Returns True
@@ -406,6 +905,7 @@ class Packager:
                 # Then, make it a bool.
                 self.platformSpecificConfig = bool(self.platformSpecificConfig)
                 del self.configs['platform_specific']
+            self.excludeSeq += 1
 
             # A special case when building the "panda3d" package.  We
             # enforce that the version number matches what we've been
@@ -424,7 +924,7 @@ class Packager:
 
             if self.p3dApplication:
                 # Default compression level for an app.
-                self.compressionLevel = 6
+                self.compressionLevel = self.packager.p3dCompressionLevel
 
                 # Every p3dapp requires panda3d.
                 if 'panda3d' not in [p.packageName for p in self.requires]:
@@ -459,6 +959,37 @@ class Packager:
             return result
 
 
+        def __sortFiles(self, files, sourceFiles, componentFiles, modelFiles):
+            """ Sorts the indicated files, skipping any excluded ones,
+            into the lists processed by each pass of
+            installMultifile(). """
+
+            for file in files:
+                if file.isExcluded(self):
+                    # Skip this file.
+                    continue
+
+                if file.unprocessed:
+                    # Add an unprocessed file verbatim.
+                    componentFiles.append((self.addComponent, file))
+                    continue
+
+                ext = file.extension
+                if ext == 'py':
+                    sourceFiles.append(file)
+                elif ext == 'dc':
+                    # dc files get a special treatment.
+                    sourceFiles.append(file)
+                    componentFiles.append((self.addDcFile, file))
+                elif ext == 'prc':
+                    # So do prc files.
+                    componentFiles.append((self.addPrcFile, file))
+                elif ext == 'egg' or ext == 'bam':
+                    modelFiles.append(file)
+                else:
+                    # Any other file.
+                    componentFiles.append((self.addComponent, file))
+
         def considerPlatform(self):
             # Check to see if any of the files are platform-specific,
             # making the overall package platform-specific.
@@ -487,6 +1018,16 @@ class Packager:
 
             self.multifile = Multifile()
 
+            # The in-memory streams added to the multifile since the
+            # last flush, and their total size.  See addSubfileStream().
+            self.pendingStreams = []
+            self.pendingStreamBytes = 0
+
+            # Set true when a subfile already in the multifile is
+            # replaced, leaving a gap that only repack() can reclaim.
+            # See __noteReplacedSubfile().
+            self.multifileHasGaps = False
+
             # Write the multifile to a temporary filename until we
             # know enough to determine the output filename.
             multifileFilename = Filename.temporary('', self.packageName + '.', '.mf')
@@ -514,17 +1055,25 @@ class Packager:
             self.extracts = []
             self.components = []
 
+            # The extract files whose file specs have yet to be made,
+            # as (lowercase name, pathname, newName) tuples.  Their
+            # hashes are computed together in writeDescFile().
+            self.extractFiles = []
+
+            # Sort the files into the passes that will process them,
+            # so we only have to walk the files list once.  Each
+            # component entry is a (method, file) pair, in the
+            # original order.
+            sourceFiles = []
+            componentFiles = []
+            modelFiles = []
+            self.__sortFiles(self.files, sourceFiles, componentFiles, modelFiles)
+            numSorted = len(self.files)
+
             # Add the explicit py files that were requested by the
             # pdef file.  These get turned into Python modules.
-            for file in self.files:
-                if file.isExcluded(self):
-                    # Skip this file.
-                    continue
-                if file.unprocessed:
-                    # Unprocessed files get dealt with below.
-                    continue
-
-                ext = Filename(file.newName).getExtension()
+            for file in sourceFiles:
+                ext = file.extension
                 if ext == 'dc':
                     # Add the modules named implicitly in the dc file.
                     self.addDcImports(file)
@@ -566,13 +1115,14 @@ class Packager:
 
             # OK, we can add it.
             self.freezer.addToMultifile(self.multifile, self.compressionLevel)
+            if self.freezer.removedSubfiles:
+                self.multifileHasGaps = True
             self.addExtensionModules()
 
-            # Add known module names.
+            # Add known module names.  There's no need to sort them
+            # here; self.components is sorted before it is written.
             self.moduleNames = {}
-            modules = self.freezer.modules.items()
-            modules.sort()
-            for newName, mdef in modules:
+            for newName, mdef in self.freezer.modules.iteritems():
                 if mdef.guess:
                     # Not really a module.
                     continue
@@ -593,7 +1143,7 @@ class Packager:
 
                 self.moduleNames[newName] = mdef
 
-                xmodule = TiXmlElement('module')
+                xmodule = XmlNode('module')
                 xmodule.SetAttribute('name', newName)
                 if mdef.exclude:
                     xmodule.SetAttribute('exclude', '1')
@@ -604,72 +1154,35 @@ class Packager:
                 self.components.append(('m', newName.lower(), xmodule))
 
             # Now look for implicit shared-library dependencies.
-            if self.packager.platform.startswith('win'):
+            if self.packager.isWindows:
                 self.__addImplicitDependenciesWindows()
-            elif self.packager.platform.startswith('osx'):
+            elif self.packager.isOsx:
                 self.__addImplicitDependenciesOSX()
             else:
                 self.__addImplicitDependenciesPosix()
 
+            # The above may have added more files to the list; sort
+            # those too.
+            self.__sortFiles(self.files[numSorted:], sourceFiles, componentFiles, modelFiles)
+
             # Now add all the real, non-Python files (except model
             # files).  This will include the extension modules we just
             # discovered above.
-            for file in self.files:
-                if file.isExcluded(self):
-                    # Skip this file.
-                    continue
-                ext = Filename(file.newName).getExtension()
-                if file.unprocessed:
-                    # Add an unprocessed file verbatim.
-                    self.addComponent(file)
-                elif ext == 'py':
-                    # Already handled, above.
-                    pass
-                elif file.isExcluded(self):
-                    # Skip this file.
-                    pass
-                elif ext == 'egg' or ext == 'bam':
-                    # Skip model files this pass.
-                    pass
-                elif ext == 'dc':
-                    # dc files get a special treatment.
-                    self.addDcFile(file)
-                elif ext == 'prc':
-                    # So do prc files.
-                    self.addPrcFile(file)
-                else:
-                    # Any other file.
-                    self.addComponent(file)
+            for method, file in componentFiles:
+                method(file)
 
             # Now add the model files.  It's important to add these
             # after we have added all of the texture files, so we can
             # determine which textures need to be implicitly pulled
-            # in.
-
-            # We walk through a copy of the files list, since we might
-            # be adding more files (textures) to this list as we
-            # discover them in model files referenced in this list.
-            for file in self.files[:]:
-                if file.isExcluded(self):
-                    # Skip this file.
-                    continue
-                ext = Filename(file.newName).getExtension()
-                if file.unprocessed:
-                    # Already handled, above.
-                    pass
-                elif ext == 'py':
-                    # Already handled, above.
-                    pass
-                elif file.isExcluded(self):
-                    # Skip this file.
-                    pass
-                elif ext == 'egg':
+            # in.  We might be adding more files (textures) to the
+            # files list as we go, but those are added to the
+            # multifile directly.
+            for file in modelFiles:
+                ext = file.extension
+                if ext == 'egg':
                     self.addEggFile(file)
-                elif ext == 'bam':
-                    self.addBamFile(file)
                 else:
-                    # Handled above.
-                    pass
+                    self.addBamFile(file)
 
             # Check to see if we should be platform-specific.
             self.considerPlatform()
@@ -712,7 +1225,15 @@ class Packager:
                 self.packageFullpath = Filename(self.packager.installDir, self.packageFilename)
                 self.packageFullpath.makeDir()
 
-            self.multifile.repack()
+            # Only repack the multifile if subfiles were removed or
+            # replaced along the way; otherwise there are no gaps to
+            # reclaim, and repack() would just rewrite the whole file.
+            if self.multifileHasGaps:
+                self.multifile.repack()
+            else:
+                self.multifile.flush()
+            self.pendingStreams = []
+            self.pendingStreamBytes = 0
 
             # Also sign the multifile before we close it.
             for certificate, chain, pkey, password in self.signParams:
@@ -748,7 +1269,7 @@ class Packager:
                 pe.packageSeq = self.packageSeq
                 pe.packageSetVer = self.packageSetVer
 
-                self.packager.contents[pe.getKey()] = pe
+                self.packager.setContentsEntry(pe)
                 self.packager.contentsChanged = True
 
             self.cleanup()
@@ -775,11 +1296,25 @@ class Packager:
                 raise PackagerError, message
 
             installPath = Filename(self.packager.installDir, packageDir)
-            # Remove any files already in the installPath.
+            # Remove any files already in the installPath.  We can't
+            # simply remove the whole directory, since it may also
+            # contain the subdirectories of other platforms or
+            # versions of this package.
             origFiles = vfs.scanDirectory(installPath)
             if origFiles:
-                for origFile in origFiles:
-                    origFile.getFilename().unlink()
+                filenames = [origFile.getFilename() for origFile in origFiles]
+                numThreads = self.packager.packagerThreads
+                if len(filenames) > 1 and numThreads > 1:
+                    from multiprocessing.pool import ThreadPool
+                    pool = ThreadPool(min(numThreads, len(filenames)))
+                    try:
+                        pool.map(lambda filename: filename.unlink(), filenames)
+                    finally:
+                        pool.close()
+                        pool.join()
+                else:
+                    for filename in filenames:
+                        filename.unlink()
 
             files = []
             for file in self.files:
@@ -817,7 +1352,7 @@ class Packager:
             if self.packageSetVer:
                 pe.packageSetVer = self.packageSetVer
 
-            self.packager.contents[pe.getKey()] = pe
+            self.packager.setContentsEntry(pe)
             self.packager.contentsChanged = True
 
             self.cleanup()
@@ -835,7 +1370,11 @@ class Packager:
             object, or None if it was not added by this call. """
 
             file = Packager.PackFile(self, *args, **kw)
-            if file.filename in self.sourceFilenames:
+
+            # The filename is used as a dictionary key in its string
+            # form, which is cheaper to hash than a Filename.
+            sourceName = str(file.filename)
+            if sourceName in self.sourceFilenames:
                 # Don't bother, it's already here.
                 return None
 
@@ -847,7 +1386,7 @@ class Packager:
                     "%s is shadowing %s" % (file2.filename, file.filename))
                 return None
 
-            self.sourceFilenames[file.filename] = file
+            self.sourceFilenames[sourceName] = file
             if file.required:
                 self.requiredFilenames.append(file)
 
@@ -866,6 +1405,84 @@ class Packager:
             package. """
             xfile = Packager.ExcludeFilename(self.packager, filename, self.packager.caseSensitive)
             self.excludedFilenames.append(xfile)
+            self.excludeSeq += 1
+
+        def __cacheDependencies(self, kind, readFunc):
+            """ Returns a function that wraps readFunc, remembering
+            its result in packager.dependencyCache.  The result is
+            keyed on the identity of the file on disk, and on the
+            architecture we're packing for, so that a library shared
+            by many executables, or by several packages, is only
+            read once per run.  readFunc must not modify the file. """
+
+            cache = self.packager.dependencyCache
+            arch = self.arch
+
+            def readCached(file):
+                pathname = file.filename.toOsSpecific()
+                try:
+                    st = os.stat(pathname)
+                except OSError:
+                    return readFunc(file)
+
+                # The pathname is part of the key, since st_ino is
+                # not meaningful on Windows.
+                key = (kind, arch, pathname, st.st_dev, st.st_ino,
+                       st.st_mtime, st.st_size)
+                if key in cache:
+                    result = cache[key]
+                else:
+                    result = readFunc(file)
+                    cache[key] = result
+
+                # Return a copy, since the caller may extend the list.
+                if result is not None:
+                    result = list(result)
+                return result
+
+            return readCached
+
+        def __scanExecutables(self, readFunc):
+            """ Walks through the list of files, yielding a (file,
+            result) tuple for each executable file that is not
+            excluded, where result is the return value of
+            readFunc(file).
+
+            We walk through the list as the caller modifies it.
+            That's OK, because we want to follow the transitive
+            closure of dependencies anyway.  The files are read in
+            batches: each batch is all of the files added since the
+            previous batch, and its readFunc calls are farmed out to
+            a pool of up to packager.packagerThreads threads.  The
+            files are still yielded in list order. """
+
+            pool = None
+            numThreads = self.packager.packagerThreads
+
+            try:
+                i = 0
+                while i < len(self.files):
+                    batch = []
+                    for file in self.files[i:]:
+                        if file.executable and not file.isExcluded(self):
+                            batch.append(file)
+                    i = len(self.files)
+
+                    if len(batch) > 1 and numThreads > 1:
+                        if pool is None:
+                            from multiprocessing.pool import ThreadPool
+                            pool = ThreadPool(numThreads)
+                        results = pool.map(readFunc, batch)
+                    else:
+                        results = map(readFunc, batch)
+
+                    for file, result in zip(batch, results):
+                        yield file, result
+
+            finally:
+                if pool is not None:
+                    pool.close()
+                    pool.join()
 
         def __addImplicitDependenciesWindows(self):
             """ Walks through the list of files, looking for dll's and
@@ -873,17 +1490,15 @@ class Packager:
             dll's and assembly manifests.  Tries to determine those
             dependencies, and adds them back into the filelist. """
 
-            # We walk through the list as we modify it.  That's OK,
-            # because we want to follow the transitive closure of
-            # dependencies anyway.
-            for file in self.files:
-                if not file.executable:
-                    continue
-
-                if file.isExcluded(self):
-                    # Skip this file.
-                    continue
+            def readImports(file):
+                if file.filename.getExtension().lower() == "manifest":
+                    return None
+                return self.__readPEImports(file)
 
+            # The import tables are read ahead of time, possibly in
+            # parallel.
+            readImports = self.__cacheDependencies('pe', readImports)
+            for file, filenames in self.__scanExecutables(readImports):
                 if file.filename.getExtension().lower() == "manifest":
                     filenames = self.__parseManifest(file.filename)
                     if filenames is None:
@@ -891,19 +1506,18 @@ class Packager:
                         continue
 
                 else:
-                    tempFile = Filename.temporary('', 'p3d_', '.txt')
-                    command = 'dumpbin /dependents "%s" >"%s"' % (
-                        file.filename.toOsSpecific(),
-                        tempFile.toOsSpecific())
-                    try:
-                        os.system(command)
-                    except:
-                        pass
-                    filenames = None
-
-                    if tempFile.exists():
-                        filenames = self.__parseDependenciesWindows(tempFile)
-                        tempFile.unlink()
+                    # If we couldn't read the import table directly
+                    # from the PE file, perhaps dumpbin will help us.
+                    if filenames is None:
+                        self.notify.warning("Reading PE file %s failed, using dumpbin instead" % (file.filename))
+                        try:
+                            handle = subprocess.Popen(
+                                ['dumpbin', '/dependents', file.filename.toOsSpecific()],
+                                stdout = subprocess.PIPE)
+                            out, err = handle.communicate()
+                            filenames = self.__parseDependenciesWindows(out)
+                        except OSError:
+                            pass
                     if filenames is None:
                         self.notify.warning("Unable to determine dependencies from %s" % (file.filename))
                         filenames = []
@@ -961,42 +1575,117 @@ class Packager:
                     self.addFile(filename, newName = str(newName),
                                  explicit = False, executable = True)
 
-        def __parseDependenciesWindows(self, tempFile):
-            """ Reads the indicated temporary file, the output from
-            dumpbin /dependents, to determine the list of dll's this
-            executable file depends on. """
+        def __readPEImports(self, file):
+            """ Reads the import table of the indicated PE executable
+            or dll, and returns the list of dll's it depends on.
+            Returns None if the file failed to read (e.g. not a PE
+            file). """
 
-            lines = open(tempFile.toOsSpecific(), 'rU').readlines()
-            li = 0
-            while li < len(lines):
-                line = lines[li]
-                li += 1
-                if line.find(' has the following dependencies') != -1:
-                    break
+            try:
+                pe = open(file.filename.toOsSpecific(), 'rb')
+            except IOError:
+                return None
 
-            if li < len(lines):
-                line = lines[li]
-                if line.strip() == '':
-                    # Skip a blank line.
-                    li += 1
+            try:
+                # The DOS header stores the offset to the PE header.
+                dosHeader = pe.read(64)
+                if len(dosHeader) < 64 or not dosHeader.startswith('MZ'):
+                    return None
+                peOffset, = struct.unpack_from('<I', dosHeader, 0x3C)
+
+                # Read the PE signature and the COFF file header.
+                pe.seek(peOffset)
+                header = pe.read(24)
+                if len(header) < 24 or not header.startswith('PE\0\0'):
+                    return None
+                machine, numSections, timestamp, symtab, numSymbols, optSize, flags \
+                  = struct.unpack_from('<HHIIIHH', header, 4)
+
+                # The optional header contains the data directories,
+                # whose second entry locates the import table.
+                optHeader = pe.read(optSize)
+                if len(optHeader) < 2:
+                    return None
+                magic, = struct.unpack_from('<H', optHeader, 0)
+                if magic == 0x10b:
+                    # PE32
+                    numDirsOffset = 92
+                elif magic == 0x20b:
+                    # PE32+
+                    numDirsOffset = 108
+                else:
+                    return None
+
+                if len(optHeader) < numDirsOffset + 20:
+                    return None
+                numDirs, = struct.unpack_from('<I', optHeader, numDirsOffset)
+                if numDirs < 2:
+                    # No import table.
+                    return []
+                importRva, importSize = struct.unpack_from('<II', optHeader, numDirsOffset + 12)
+                if importRva == 0:
+                    return []
+
+                # The section table immediately follows the optional
+                # header.  We need it to map RVA's to file offsets.
+                sections = []
+                for i in range(numSections):
+                    name, vsize, vaddr, rawSize, rawOffset \
+                      = struct.unpack('<8sIIII', pe.read(24))
+                    pe.read(16)
+                    sections.append((vaddr, max(vsize, rawSize), rawOffset))
+
+                def rvaToOffset(rva):
+                    for vaddr, size, rawOffset in sections:
+                        if vaddr <= rva < vaddr + size:
+                            return rva - vaddr + rawOffset
+                    return None
+
+                offset = rvaToOffset(importRva)
+                if offset is None:
+                    return None
+
+                # Walk the import descriptors, until we reach the
+                # terminating null entry.
+                filenames = []
+                while True:
+                    pe.seek(offset)
+                    data = pe.read(20)
+                    if len(data) < 20:
+                        return None
+                    lookup, timestamp, chain, nameRva, thunk = struct.unpack('<IIIII', data)
+                    if nameRva == 0:
+                        break
 
-            # Now we're finding filenames, until the next blank line.
-            filenames = []
-            while li < len(lines):
-                line = lines[li]
-                li += 1
-                line = line.strip()
-                if line == '':
-                    # We're done.
-                    return filenames
-                filenames.append(line)
+                    nameOffset = rvaToOffset(nameRva)
+                    if nameOffset is not None:
+                        pe.seek(nameOffset)
+                        filenames.append(pe.read(256).split('\0', 1)[0])
+                    offset += 20
+
+                return filenames
+
+            except struct.error:
+                return None
 
-            # Hmm, we ran out of data.  Oh well.
+            finally:
+                pe.close()
+
+        def __parseDependenciesWindows(self, output):
+            """ Parses the indicated string, the output from dumpbin
+            /dependents, to determine the list of dll's this
+            executable file depends on.  Returns None on a parse
+            error. """
+
+            match = self.dumpbinDependsRE.search(output)
+            if not match:
+                return None
+
+            filenames = [line.strip() for line in match.group(1).splitlines()]
             if not filenames:
                 # Some parse error.
                 return None
 
-            # At least we got some data.
             return filenames
 
         def __parseManifest(self, tempFile):
@@ -1108,34 +1797,10 @@ class Packager:
             on other dylib's.  Tries to determine those dependencies,
             and adds them back into the filelist. """
 
-            # We walk through the list as we modify it.  That's OK,
-            # because we want to follow the transitive closure of
-            # dependencies anyway.
-            for file in self.files:
-                if not file.executable:
-                    continue
-
-                if file.isExcluded(self):
-                    # Skip this file.
-                    continue
-
-                tempFile = Filename.temporary('', 'p3d_', '.txt')
-                command = '/usr/bin/otool -arch all -L "%s" >"%s"' % (
-                    file.filename.toOsSpecific(),
-                    tempFile.toOsSpecific())
-                if self.arch:
-                    command = '/usr/bin/otool -arch %s -L "%s" >"%s"' % (
-                        self.arch,
-                        file.filename.toOsSpecific(),
-                        tempFile.toOsSpecific())
-                exitStatus = os.system(command)
-                if exitStatus != 0:
-                    self.notify.warning('Command failed: %s' % (command))
-                filenames = None
-
-                if tempFile.exists():
-                    filenames = self.__parseDependenciesOSX(tempFile)
-                    tempFile.unlink()
+            # The otool commands are run ahead of time, possibly in
+            # parallel.
+            readDependencies = self.__cacheDependencies('macho', self.__readDependenciesOSX)
+            for file, filenames in self.__scanExecutables(readDependencies):
                 if filenames is None:
                     self.notify.warning("Unable to determine dependencies from %s" % (file.filename))
                     continue
@@ -1162,6 +1827,13 @@ class Packager:
                         # aren't commonly on the library path either.
                         filename = self.__locateFrameworkLibrary(filename)
                         filename.setBinary()
+                    elif "/System/" in filename:
+                        # Resolving it would only prepend a directory,
+                        # and we'd skip it below anyway.
+                        continue
+                    elif filename.startswith(self.osxSystemLibraryDirs):
+                        # A library that ships with OSX itself.
+                        continue
                     else:
                         # It's just a normal library - find it on the path.
                         filename = Filename.fromOsSpecific(filename)
@@ -1185,31 +1857,136 @@ class Packager:
                     self.addFile(filename, newName = str(newName),
                                  explicit = False, executable = True)
 
-        def __parseDependenciesOSX(self, tempFile):
-            """ Reads the indicated temporary file, the output from
-            otool -L, to determine the list of dylibs this
-            executable file depends on. """
+        def __readDependenciesOSX(self, file):
+            """ Returns the list of dylibs the indicated file depends
+            on, or None on failure.  The Mach-O load commands are
+            read directly if possible; otherwise, we run otool -L on
+            the file, and read its output directly from a pipe. """
 
-            lines = open(tempFile.toOsSpecific(), 'rU').readlines()
+            filenames = self.__readMachODependencies(file)
+            if filenames is not None:
+                return filenames
 
-            filenames = []
-            for line in lines:
-                if line[0] not in string.whitespace:
-                    continue
-                line = line.strip()
-                s = line.find(' (compatibility')
-                if s != -1:
-                    line = line[:s]
+            command = ['/usr/bin/otool', '-arch', self.arch or 'all',
+                       '-L', file.filename.toOsSpecific()]
+            try:
+                handle = subprocess.Popen(command, stdout = subprocess.PIPE)
+                out, err = handle.communicate()
+            except OSError:
+                self.notify.warning('Command failed: %s' % (' '.join(command)))
+                return None
+
+            if handle.returncode != 0:
+                self.notify.warning('Command failed: %s' % (' '.join(command)))
+
+            return self.__parseDependenciesOSX(out)
+
+        def __readMachODependencies(self, file):
+            """ Reads the load commands of the indicated Mach-O file,
+            which may be a universal binary, and returns the list of
+            dylibs it depends on.  Only the headers are read, not the
+            whole file.  Returns None if the file failed to read
+            (e.g. not a Mach-O file). """
+
+            try:
+                macho = open(file.filename.toOsSpecific(), 'rb')
+            except IOError:
+                return None
+
+            try:
+                magic = macho.read(4)
+                if len(magic) < 4:
+                    return None
+
+                if magic in ('\xca\xfe\xba\xbe', '\xca\xfe\xba\xbf'):
+                    # A universal binary.  The fat header, which is
+                    # always big-endian, lists the offset of the image
+                    # for each architecture.
+                    nfat, = struct.unpack('>I', macho.read(4))
+                    if nfat > 32:
+                        # Probably a Java class file, which shares the
+                        # same magic number.
+                        return None
+
+                    images = []
+                    for i in range(nfat):
+                        if magic == '\xca\xfe\xba\xbe':
+                            cputype, cpusubtype, offset, size, align = struct.unpack('>iiIII', macho.read(20))
+                        else:
+                            cputype, cpusubtype, offset, size, align, reserved = struct.unpack('>iiQQII', macho.read(32))
+                        images.append((cputype, offset))
+
+                    if self.arch:
+                        # Only consider the architecture we're packing.
+                        cputype = self.machOCpuTypes.get(self.arch)
+                        if cputype is None:
+                            return None
+                        images = [image for image in images if image[0] == cputype]
                 else:
-                    s = line.find('.dylib')
-                    if s != -1:
-                        line = line[:s + 6]
-                    else:
-                        continue
-                filenames.append(line)
+                    images = [(None, 0)]
+
+                filenames = []
+                for cputype, offset in images:
+                    names = self.__readMachOImage(macho, offset)
+                    if names is None:
+                        return None
+                    for name in names:
+                        if name not in filenames:
+                            filenames.append(name)
+
+                return filenames
+
+            except struct.error:
+                return None
+
+            finally:
+                macho.close()
+
+        def __readMachOImage(self, macho, offset):
+            """ Reads the single-architecture Mach-O image at the
+            indicated offset within the open file, and returns the
+            names of the dylibs named by its load commands, or None
+            if it isn't a Mach-O image. """
+
+            macho.seek(offset)
+            header = macho.read(32)
+            if len(header) < 32:
+                return None
+
+            for endian in '<>':
+                magic, = struct.unpack_from(endian + 'I', header, 0)
+                if magic in (0xfeedface, 0xfeedfacf):
+                    break
+            else:
+                return None
+
+            ncmds, sizeofcmds = struct.unpack_from(endian + 'II', header, 16)
+            if magic == 0xfeedface:
+                # The 32-bit header is 4 bytes shorter.
+                macho.seek(offset + 28)
+            commands = macho.read(sizeofcmds)
+
+            filenames = []
+            p = 0
+            for i in range(ncmds):
+                cmd, cmdsize = struct.unpack_from(endian + 'II', commands, p)
+                if cmdsize < 8:
+                    return None
+                if cmd in self.machODylibCommands:
+                    nameOffset, = struct.unpack_from(endian + 'I', commands, p + 8)
+                    name = commands[p + nameOffset : p + cmdsize]
+                    filenames.append(name.split('\0', 1)[0])
+                p += cmdsize
 
             return filenames
 
+        def __parseDependenciesOSX(self, output):
+            """ Parses the indicated string, the output from otool
+            -L, to determine the list of dylibs this executable file
+            depends on. """
+
+            return self.otoolDependsRE.findall(output)
+
         def __readAndStripELF(self, file):
             """ Reads the indicated ELF binary, and returns a list with
             dependencies.  If it contains data that should be stripped,
@@ -1264,7 +2041,7 @@ class Packager:
                 elf.seek(offset)
                 data = elf.read(entsize)
                 tag, val = struct.unpack_from(dynamicStruct, data)
-                newSectionData = ""
+                newSectionData = []
                 startReplace = None
                 pad = 0
 
@@ -1282,14 +2059,15 @@ class Packager:
                             pad += entsize
 
                     elif startReplace is not None:
-                        newSectionData += data
+                        newSectionData.append(data)
 
                     data = elf.read(entsize)
                     tag, val = struct.unpack_from(dynamicStruct, data)
 
                 if startReplace is not None:
-                    newSectionData += data + ("\0" * pad)
-                    rewriteSections.append((startReplace, newSectionData))
+                    newSectionData.append(data)
+                    newSectionData.append("\0" * pad)
+                    rewriteSections.append((startReplace, ''.join(newSectionData)))
             elf.close()
 
             # No rpaths/runpaths found, so nothing to do any more.
@@ -1331,36 +2109,10 @@ class Packager:
             on other so's.  Tries to determine those dependencies,
             and adds them back into the filelist. """
 
-            # We walk through the list as we modify it.  That's OK,
-            # because we want to follow the transitive closure of
-            # dependencies anyway.
-            for file in self.files:
-                if not file.executable:
-                    continue
-
-                if file.isExcluded(self):
-                    # Skip this file.
-                    continue
-
-                # Check if this is an ELF binary.
-                filenames = self.__readAndStripELF(file)
-
-                # If that failed, perhaps ldd will help us.
-                if filenames is None:
-                    self.notify.warning("Reading ELF library %s failed, using ldd instead" % (file.filename))
-                    tempFile = Filename.temporary('', 'p3d_', '.txt')
-                    command = 'ldd "%s" >"%s"' % (
-                        file.filename.toOsSpecific(),
-                        tempFile.toOsSpecific())
-                    try:
-                        os.system(command)
-                    except:
-                        pass
-
-                    if tempFile.exists():
-                        filenames = self.__parseDependenciesPosix(tempFile)
-                        tempFile.unlink()
-
+            # Each file is first checked to see if it is an ELF
+            # binary, falling back to ldd if it isn't; this is done
+            # ahead of time, possibly in parallel.
+            for file, filenames in self.__scanExecutables(self.__readDependenciesPosix):
                 if filenames is None:
                     self.notify.warning("Unable to determine dependencies from %s" % (file.filename))
                     continue
@@ -1373,7 +2125,7 @@ class Packager:
                 for filename in filenames:
                     # These vDSO's provided by Linux aren't
                     # supposed to be anywhere on the system.
-                    if filename in ["linux-gate.so.1", "linux-vdso.so.1"]:
+                    if filename in self.linuxVirtualLibraries:
                         continue
 
                     filename = Filename.fromOsSpecific(filename)
@@ -1384,24 +2136,34 @@ class Packager:
                     self.addFile(filename, newName = str(newName),
                                  explicit = False, executable = True)
 
-        def __parseDependenciesPosix(self, tempFile):
-            """ Reads the indicated temporary file, the output from
-            ldd, to determine the list of so's this executable file
-            depends on. """
+        def __readDependenciesPosix(self, file):
+            """ Returns the list of so's the indicated file depends
+            on, or None on failure.  The ELF file is read (and
+            stripped) directly if possible; otherwise, we run ldd on
+            the file, and read its output directly from a pipe. """
 
-            lines = open(tempFile.toOsSpecific(), 'rU').readlines()
+            filenames = self.__readAndStripELF(file)
+            if filenames is not None:
+                return filenames
 
-            filenames = []
-            for line in lines:
-                line = line.strip()
-                s = line.find(' => ')
-                if s == -1:
-                    continue
+            # If that failed, perhaps ldd will help us.
+            self.notify.warning("Reading ELF library %s failed, using ldd instead" % (file.filename))
+            command = ['ldd', file.filename.toOsSpecific()]
+            try:
+                handle = subprocess.Popen(command, stdout = subprocess.PIPE)
+                out, err = handle.communicate()
+            except OSError:
+                self.notify.warning('Command failed: %s' % (' '.join(command)))
+                return None
 
-                line = line[:s].strip()
-                filenames.append(line)
+            return self.__parseDependenciesPosix(out)
 
-            return filenames
+        def __parseDependenciesPosix(self, output):
+            """ Parses the indicated string, the output from ldd, to
+            determine the list of so's this executable file depends
+            on. """
+
+            return self.lddDependsRE.findall(output)
 
         def addExtensionModules(self):
             """ Adds the extension modules detected by the freezer to
@@ -1427,11 +2189,7 @@ class Packager:
             """ Makes the p3d_info.xml file that defines the
             application startup parameters and such. """
 
-            doc = TiXmlDocument()
-            decl = TiXmlDeclaration("1.0", "utf-8", "")
-            doc.InsertEndChild(decl)
-
-            xpackage = TiXmlElement('package')
+            xpackage = XmlNode('package')
             xpackage.SetAttribute('name', self.packageName)
             if self.platform:
                 xpackage.SetAttribute('platform', self.platform)
@@ -1444,7 +2202,7 @@ class Packager:
 
             requireHosts = {}
             for package in self.requires:
-                xrequires = TiXmlElement('requires')
+                xrequires = XmlNode('requires')
                 xrequires.SetAttribute('name', package.packageName)
                 if package.version:
                     xrequires.SetAttribute('version', package.version)
@@ -1457,35 +2215,28 @@ class Packager:
             for host in requireHosts.keys():
                 he = self.packager.hosts.get(host, None)
                 if he:
-                    xhost = he.makeXml(packager = self.packager)
+                    xhost = he.makeXml(packager = self.packager, elementClass = XmlNode)
                     xpackage.InsertEndChild(xhost)
 
-            doc.InsertEndChild(xpackage)
-
-            # Write the xml file to a temporary file on disk, so we
-            # can add it to the multifile.
-            filename = Filename.temporary('', 'p3d_', '.xml')
-
-            # This should really be setText() for an xml file, but it
-            # doesn't really matter that much since tinyxml can read
-            # it either way; and if we use setBinary() it will remain
-            # compatible with older versions of the core API that
-            # didn't understand the SF_text flag.
-            filename.setBinary()
-
-            doc.SaveFile(filename.toOsSpecific())
+            # Write the xml data into memory, and add it to the
+            # multifile from there.
+            out = cStringIO.StringIO()
+            writeXmlDocument(out, xpackage)
+            stream = StringStream(out.getvalue())
 
             # It's important not to compress this file: the core API
             # runtime can't decode compressed subfiles.
-            self.multifile.addSubfile('p3d_info.xml', filename, 0)
-
-            self.multifile.flush()
-            filename.unlink()
+            self.addSubfileStream('p3d_info.xml', stream, 0)
 
 
         def compressMultifile(self):
             """ Compresses the .mf file into an .mf.pz file. """
 
+            if self.__isCompressedMultifileCurrent():
+                # The previous .mf.pz file was made from exactly the
+                # same .mf file, so there's nothing to do.
+                return
+
             if self.oldCompressedBasename:
                 # Remove the previous compressed file first.
                 compressedPath = Filename(self.packager.installDir, Filename(self.packageDir, self.oldCompressedBasename))
@@ -1495,10 +2246,82 @@ class Packager:
 
             # Now build the new version.
             compressedPath = Filename(self.packager.installDir, newCompressedFilename)
-            if not compressFile(self.packageFullpath, compressedPath, 6):
+            compressionLevel = self.packager.pzCompressionLevel
+            if self.__compressWithPigz(compressedPath, compressionLevel):
+                return
+
+            if not compressFile(self.packageFullpath, compressedPath, compressionLevel):
                 message = 'Unable to write %s' % (compressedPath)
                 raise PackagerError, message
 
+        def __isCompressedMultifileCurrent(self):
+            """ Returns true if the .mf.pz file left by the previous
+            build is still on disk, under the same name, and was
+            compressed from an .mf file identical to the one we have
+            just built, according to the hashes recorded in the
+            previous desc file. """
+
+            if not self.oldUncompressedHash or not self.oldCompressedHash:
+                return False
+            if self.oldCompressedBasename != self.packageBasename + '.pz':
+                return False
+
+            compressedPath = Filename(self.packager.installDir, '%s.pz' % (self.packageFilename))
+            if not compressedPath.exists():
+                return False
+
+            uncompressedHash = hashFile(self.packageFullpath)
+            self.knownHashes[str(self.packageFullpath)] = uncompressedHash
+            if uncompressedHash != self.oldUncompressedHash:
+                return False
+
+            if hashFile(compressedPath) != self.oldCompressedHash:
+                return False
+
+            self.knownHashes[str(compressedPath)] = self.oldCompressedHash
+            return True
+
+        def __compressWithPigz(self, compressedPath, compressionLevel):
+            """ Attempts to compress the .mf file with pigz, a
+            parallel implementation of zlib compression, if it is
+            available on the PATH.  Its -z output is in the same zlib
+            format written by compressFile().  Returns true on
+            success, or false if the caller should fall back to
+            compressFile(). """
+
+            if self.packager.havePigz is False:
+                # We already know it isn't there.
+                return False
+
+            # pigz uses all of the available cores by default.
+            command = ['pigz', '-z', '-c', '-%s' % (compressionLevel),
+                       self.packageFullpath.toOsSpecific()]
+
+            compressedPath.setBinary()
+            try:
+                out = open(compressedPath.toOsSpecific(), 'wb')
+            except IOError:
+                return False
+
+            try:
+                try:
+                    exitStatus = subprocess.call(command, stdout = out)
+                except OSError:
+                    # pigz isn't installed.  Don't try again for the
+                    # next package.
+                    self.packager.havePigz = False
+                    exitStatus = None
+            finally:
+                out.close()
+
+            if exitStatus != 0:
+                if exitStatus is not None:
+                    self.notify.warning('Command failed: %s' % (' '.join(command)))
+                compressedPath.unlink()
+                return False
+
+            return True
+
         def readDescFile(self):
             """ Reads the existing package.xml file before rewriting
             it.  We need this to preserve the list of patches, and
@@ -1510,14 +2333,12 @@ class Packager:
             self.patches = []
 
             self.oldCompressedBasename = None
+            self.oldUncompressedHash = None
+            self.oldCompressedHash = None
 
             packageDescFullpath = Filename(self.packager.installDir, self.packageDesc)
-            doc = TiXmlDocument(packageDescFullpath.toOsSpecific())
-            if not doc.LoadFile():
-                return
-
-            xpackage = doc.FirstChildElement('package')
-            if not xpackage:
+            xpackage = loadXmlFile(packageDescFullpath)
+            if not xpackage or xpackage.element.tag != 'package':
                 return
 
             perPlatform = xpackage.Attribute('per_platform')
@@ -1526,11 +2347,16 @@ class Packager:
             self.packageSeq.loadXml(xpackage, 'seq')
             self.packageSetVer.loadXml(xpackage, 'set_ver')
 
+            xuncompressed = xpackage.FirstChildElement('uncompressed_archive')
+            if xuncompressed:
+                self.oldUncompressedHash = xuncompressed.Attribute('hash')
+
             xcompressed = xpackage.FirstChildElement('compressed_archive')
             if xcompressed:
                 compressedFilename = xcompressed.Attribute('filename')
                 if compressedFilename:
                     self.oldCompressedBasename = compressedFilename
+                    self.oldCompressedHash = xcompressed.Attribute('hash')
 
             patchVersion = xpackage.Attribute('patch_version')
             if not patchVersion:
@@ -1558,11 +2384,8 @@ class Packager:
             and its contents, for download. """
 
             packageDescFullpath = Filename(self.packager.installDir, self.packageDesc)
-            doc = TiXmlDocument(packageDescFullpath.toOsSpecific())
-            decl = TiXmlDeclaration("1.0", "utf-8", "")
-            doc.InsertEndChild(decl)
 
-            xpackage = TiXmlElement('package')
+            xpackage = XmlNode('package')
             xpackage.SetAttribute('name', self.packageName)
             if self.platform:
                 xpackage.SetAttribute('platform', self.platform)
@@ -1580,7 +2403,7 @@ class Packager:
             self.__addConfigs(xpackage)
 
             for package in self.requires:
-                xrequires = TiXmlElement('requires')
+                xrequires = XmlNode('requires')
                 xrequires.SetAttribute('name', package.packageName)
                 if self.platform and package.platform:
                     xrequires.SetAttribute('platform', package.platform)
@@ -1591,43 +2414,50 @@ class Packager:
                 xrequires.SetAttribute('host', package.host)
                 xpackage.InsertEndChild(xrequires)
 
-            xuncompressedArchive = self.getFileSpec(
-                'uncompressed_archive', self.packageFullpath,
-                self.packageBasename)
+            # Make the file specs for the archives and the extract
+            # files all at once, so they can be hashed in parallel.
+            specs = [('uncompressed_archive', self.packageFullpath,
+                      self.packageBasename),
+                     ('compressed_archive', self.packageFullpath + '.pz',
+                      self.packageBasename + '.pz')]
+            for name, pathname, newName in self.extractFiles:
+                specs.append(('extract', pathname, newName))
+            xspecs = self.getFileSpecs(specs)
+
+            xuncompressedArchive, xcompressedArchive = xspecs[:2]
             xpackage.InsertEndChild(xuncompressedArchive)
-
-            xcompressedArchive = self.getFileSpec(
-                'compressed_archive', self.packageFullpath + '.pz',
-                self.packageBasename + '.pz')
             xpackage.InsertEndChild(xcompressedArchive)
 
+            for (name, pathname, newName), xextract in zip(self.extractFiles, xspecs[2:]):
+                self.extracts.append((name, xextract))
+            self.extractFiles = []
+
             # Copy in the patch entries read from the previous version
             # of the desc file.
             for xpatch in self.patches:
                 xpackage.InsertEndChild(xpatch)
 
-            self.extracts.sort()
+            # Sort on the names only; the elements themselves need
+            # never be compared, and ties keep their original order.
+            self.extracts.sort(key = operator.itemgetter(0))
             for name, xextract in self.extracts:
                 xpackage.InsertEndChild(xextract)
 
-            doc.InsertEndChild(xpackage)
-            doc.SaveFile()
+            self.__writeXmlFile(packageDescFullpath, xpackage)
 
         def __addConfigs(self, xpackage):
             """ Adds the XML config values defined in self.configs to
             the indicated XML element. """
 
             if self.configs:
-                xconfig = TiXmlElement('config')
-
-                for variable, value in self.configs.items():
-                    if isinstance(value, types.UnicodeType):
-                        xconfig.SetAttribute(variable, value.encode('utf-8'))
-                    elif isinstance(value, types.BooleanType):
-                        # True or False must be encoded as 1 or 0.
-                        xconfig.SetAttribute(variable, str(int(value)))
-                    else:
-                        xconfig.SetAttribute(variable, str(value))
+                # The variable names are unique, so the attributes can
+                # be stored directly, without SetAttribute() checking
+                # for an existing one each time.
+                xconfig = XmlNode('config')
+                encoders = self.configEncoders
+                xconfig.attributes = [
+                    (variable, encoders.get(type(value), str)(value))
+                    for variable, value in self.configs.iteritems()]
 
                 xpackage.InsertEndChild(xconfig)
 
@@ -1637,11 +2467,8 @@ class Packager:
             applications that may wish to "require" this one. """
 
             packageImportDescFullpath = Filename(self.packager.installDir, self.packageImportDesc)
-            doc = TiXmlDocument(packageImportDescFullpath.toOsSpecific())
-            decl = TiXmlDeclaration("1.0", "utf-8", "")
-            doc.InsertEndChild(decl)
 
-            xpackage = TiXmlElement('package')
+            xpackage = XmlNode('package')
             xpackage.SetAttribute('name', self.packageName)
             if self.platform:
                 xpackage.SetAttribute('platform', self.platform)
@@ -1656,7 +2483,7 @@ class Packager:
             requireHosts[self.host] = True
 
             for package in self.requires:
-                xrequires = TiXmlElement('requires')
+                xrequires = XmlNode('requires')
                 xrequires.SetAttribute('name', package.packageName)
                 if self.platform and package.platform:
                     xrequires.SetAttribute('platform', package.platform)
@@ -1673,28 +2500,46 @@ class Packager:
             for host in requireHosts.keys():
                 he = self.packager.hosts.get(host, None)
                 if he:
-                    xhost = he.makeXml(packager = self.packager)
+                    xhost = he.makeXml(packager = self.packager, elementClass = XmlNode)
                     xpackage.InsertEndChild(xhost)
 
-            self.components.sort()
+            self.components.sort(key = operator.itemgetter(0, 1))
             for type, name, xcomponent in self.components:
                 xpackage.InsertEndChild(xcomponent)
 
-            doc.InsertEndChild(xpackage)
-            doc.SaveFile()
+            self.__writeXmlFile(packageImportDescFullpath, xpackage)
+
+            # Don't let the packager use what it read from the
+            # previous version of this file.
+            pathname = os.path.abspath(packageImportDescFullpath.toOsSpecific())
+            self.packager.importDescFiles.pop(pathname, None)
+
+        def __writeXmlFile(self, filename, xelement):
+            """ Writes the indicated XmlNode tree to the indicated
+            file on disk, as a complete XML document. """
+
+            out = open(filename.toOsSpecific(), 'wb')
+            try:
+                writeXmlDocument(out, xelement)
+            finally:
+                out.close()
 
         def readImportDescFile(self, filename):
             """ Reads the import desc file.  Returns True on success,
             False on failure. """
 
+            return self.loadImportDescXml(loadXmlFile(filename))
+
+        def loadImportDescXml(self, xpackage):
+            """ Fills in the package from the indicated XmlElement, the
+            root of an import desc file, or None if the file couldn't
+            be read.  The packages it requires are looked up anew each
+            time.  Returns True on success, False on failure. """
+
             self.packageSeq = SeqValue()
             self.packageSetVer = SeqValue()
 
-            doc = TiXmlDocument(filename.toOsSpecific())
-            if not doc.LoadFile():
-                return False
-            xpackage = doc.FirstChildElement('package')
-            if not xpackage:
+            if not xpackage or xpackage.element.tag != 'package':
                 return False
 
             self.packageName = xpackage.Attribute('name')
@@ -1754,18 +2599,44 @@ class Packager:
 
             return True
 
+        def getFileSpecs(self, specs):
+            """ Returns a list of file spec elements, one for each
+            (element, pathname, newName) tuple in specs, as returned
+            by getFileSpec().  The files are hashed in a pool of up
+            to packager.packagerThreads threads; hashlib releases the
+            interpreter lock while it works. """
+
+            numThreads = self.packager.packagerThreads
+            if len(specs) > 1 and numThreads > 1:
+                from multiprocessing.pool import ThreadPool
+                pool = ThreadPool(min(numThreads, len(specs)))
+                try:
+                    return pool.map(lambda spec: self.getFileSpec(*spec), specs)
+                finally:
+                    pool.close()
+                    pool.join()
+
+            return [self.getFileSpec(*spec) for spec in specs]
+
         def getFileSpec(self, element, pathname, newName):
-            """ Returns an xcomponent or similar element with the file
+            """ Returns an xcomponent or similar XmlNode with the file
             information for the indicated file. """
 
-            xspec = TiXmlElement(element)
-
-            size = pathname.getFileSize()
-            timestamp = pathname.getTimestamp()
+            xspec = XmlNode(element)
 
-            hv = HashVal()
-            hv.hashFile(pathname)
-            hash = hv.asHex()
+            # One stat gives us both the size and the timestamp.
+            try:
+                st = os.stat(pathname.toOsSpecific())
+                size = st.st_size
+                timestamp = int(st.st_mtime)
+            except OSError:
+                # Not a real file; ask the vfs instead.
+                size = pathname.getFileSize()
+                timestamp = pathname.getTimestamp()
+
+            hash = self.knownHashes.get(str(pathname), None)
+            if hash is None:
+                hash = hashFile(pathname)
 
             xspec.SetAttribute('filename', newName)
             xspec.SetAttribute('size', str(size))
@@ -1809,7 +2680,7 @@ class Packager:
 
         def addEggFile(self, file):
             # Precompile egg files to bam's.
-            np = self.packager.loader.loadModel(file.filename)
+            np = self.packager.getLoader().loadModel(file.filename)
             if not np:
                 raise StandardError, 'Could not read egg file %s' % (file.filename)
 
@@ -1875,13 +2746,9 @@ class Packager:
 
             # Now we have an in-memory bam file.
             stream.seekg(0)
-            self.multifile.addSubfile(newName, stream, self.compressionLevel)
-
-            # Flush it so the data gets written to disk immediately, so we
-            # don't have to keep it around in ram.
-            self.multifile.flush()
+            self.addSubfileStream(newName, stream, self.compressionLevel)
 
-            xcomponent = TiXmlElement('component')
+            xcomponent = XmlNode('component')
             xcomponent.SetAttribute('filename', newName)
             self.components.append(('c', newName.lower(), xcomponent))
 
@@ -1890,22 +2757,38 @@ class Packager:
             not already been included.  Returns the new name within the
             package tree. """
 
+            key = str(filename)
+            newName = self.foundTextures.get(key, None)
+            if newName is not None:
+                # We've seen this one before.
+                return newName
+
+            newName = self.__addFoundTexture(filename)
+            self.foundTextures[key] = newName
+            return newName
+
+        def __addFoundTexture(self, filename):
             filename = Filename(filename)
             filename.makeCanonical()
 
-            file = self.sourceFilenames.get(filename, None)
+            file = self.sourceFilenames.get(str(filename), None)
             if file:
                 # Never mind, it's already on the list.
                 return file.newName
 
             # We have to copy the image into the plugin tree somewhere.
-            newName = self.importedMapsDir + '/' + filename.getBasename()
-            uniqueId = 0
-            while newName.lower() in self.targetFilenames:
-                uniqueId += 1
-                newName = '%s/%s_%s.%s' % (
-                    self.importedMapsDir, filename.getBasenameWoExtension(),
-                    uniqueId, filename.getExtension())
+            basename = filename.getBasename()
+            newName = self.importedMapsDir + '/' + basename
+            if newName.lower() in self.targetFilenames:
+                # Pick up where we left off numbering this name.
+                key = basename.lower()
+                uniqueId = self.importedMapIds.get(key, 0)
+                prefix = '%s/%s_' % (self.importedMapsDir, filename.getBasenameWoExtension())
+                suffix = '.' + filename.getExtension()
+                while newName.lower() in self.targetFilenames:
+                    uniqueId += 1
+                    newName = prefix + str(uniqueId) + suffix
+                self.importedMapIds[key] = uniqueId
 
             file = self.addFile(
                 filename, newName = newName, explicit = False,
@@ -1926,6 +2809,18 @@ class Packager:
             come to "compiling" a dc file, since all of the remaining
             symbols are meaningful at runtime. """
 
+            if not file.dcStripped:
+                # We haven't already read it for addDcImports().
+                self.__readDcFile(file)
+
+            self.addComponent(file)
+
+        def __readDcFile(self, file):
+            """ Reads the indicated dc file, and stores the stripped
+            version in file.text, ready for addDcFile().  Returns the
+            DCFile object, so that the caller can also examine it
+            without parsing the file a second time. """
+
             # First, read in the dc file
             from panda3d.direct import DCFile
             dcFile = DCFile()
@@ -1938,16 +2833,15 @@ class Packager:
                 self.notify.error("Unable to write %s." % (file.filename))
 
             file.text = stream.getData()
-            self.addComponent(file)
+            file.dcStripped = True
+            return dcFile
 
         def addDcImports(self, file):
             """ Adds the Python modules named by the indicated dc
-            file. """
+            file.  The stripped dc file is also saved for the later
+            call to addDcFile(). """
 
-            from panda3d.direct import DCFile
-            dcFile = DCFile()
-            if not dcFile.read(file.filename):
-                self.notify.error("Unable to parse %s." % (file.filename))
+            dcFile = self.__readDcFile(file)
 
             for n in range(dcFile.getNumImportModules()):
                 moduleName = dcFile.getImportModule(n)
@@ -1986,21 +2880,34 @@ class Packager:
             possible to set prcEncryptionKey and/or prcSignCommand to
             further manipulate prc files during processing. """
 
-            # First, read it in.
+            # First, read it in.  There's no need for universal
+            # newline translation, since splitlines() recognizes any
+            # line ending.
             if file.text:
-                textLines = file.text.split('\n')
+                textLines = file.text.splitlines()
             else:
-                textLines = open(file.filename.toOsSpecific(), 'rU').readlines()
+                textLines = open(file.filename.toOsSpecific(), 'rb').read().splitlines()
 
-            # Then write it out again, without the comments.
-            tempFilename = Filename.temporary('', 'p3d_', '.prc')
-            tempFilename.setBinary()  # Binary is more reliable for signing.
-            temp = open(tempFilename.toOsSpecific(), 'w')
+            # Then strip out the comments and blank lines.
+            lines = []
             for line in textLines:
                 line = line.strip()
                 if line and line[0] != '#':
-                    # Write the line out only if it's not a comment.
-                    temp.write(line + '\n')
+                    lines.append(line + '\n')
+            text = ''.join(lines)
+
+            if not self.packager.prcSignCommand and not self.packager.prcEncryptionKey:
+                # Nothing else to do to it, so we can add it straight
+                # from memory.
+                file.text = text
+                self.addComponent(file)
+                return
+
+            # Otherwise, write it out again so it can be processed.
+            tempFilename = Filename.temporary('', 'p3d_', '.prc')
+            tempFilename.setBinary()  # Binary is more reliable for signing.
+            temp = open(tempFilename.toOsSpecific(), 'w')
+            temp.write(text)
             temp.close()
 
             if self.packager.prcSignCommand:
@@ -2014,9 +2921,9 @@ class Packager:
 
             if self.packager.prcEncryptionKey:
                 # And now encrypt it.
-                if file.newName.endswith('.prc'):
+                if file.extension == 'prc':
                     # Change .prc -> .pre
-                    file.newName = file.newName[:-1] + 'e'
+                    file.setNewName(file.newName[:-1] + 'e', self.packager)
 
                 preFilename = Filename.temporary('', 'p3d_', '.pre')
                 preFilename.setBinary()
@@ -2034,25 +2941,52 @@ class Packager:
 
             self.addComponent(file)
 
+        def addSubfileStream(self, newName, stream, compressionLevel):
+            """ Adds the indicated in-memory StringStream to the
+            multifile.  The multifile reads the stream only when it
+            is flushed, so we must keep it alive until then.  Rather
+            than flushing after each such subfile, we let the streams
+            pile up until they hold packager.multifileFlushBytes,
+            and write them out together. """
+
+            self.__noteReplacedSubfile(newName)
+            self.multifile.addSubfile(newName, stream, compressionLevel)
+            self.pendingStreams.append(stream)
+            self.pendingStreamBytes += stream.getDataSize()
+
+            if self.pendingStreamBytes >= self.packager.multifileFlushBytes:
+                self.multifile.flush()
+                self.pendingStreams = []
+                self.pendingStreamBytes = 0
+
+        def __noteReplacedSubfile(self, newName):
+            """ Records whether adding the named subfile to the
+            multifile will replace one that is already there, in
+            which case the multifile must be repacked at the end. """
+
+            if self.multifile.findSubfile(newName) >= 0:
+                self.multifileHasGaps = True
+
         def addComponent(self, file):
             compressionLevel = 0
             if file.compress:
                 compressionLevel = self.compressionLevel
 
-            if file.text:
+            if file.text is not None:
                 stream = StringStream(file.text)
-                self.multifile.addSubfile(file.newName, stream, compressionLevel)
-                self.multifile.flush()
-
-            elif file.executable and self.arch:
-                if not self.__addOsxExecutable(file):
-                    return
+                self.addSubfileStream(file.newName, stream, compressionLevel)
 
             else:
-                # Copy an ordinary file into the multifile.
-                self.multifile.addSubfile(file.newName, file.filename, compressionLevel)
+                self.__noteReplacedSubfile(file.newName)
+                if file.executable and self.arch:
+                    if not self.__addOsxExecutable(file):
+                        return
+
+                else:
+                    # Copy an ordinary file into the multifile.
+                    self.multifile.addSubfile(file.newName, file.filename, compressionLevel)
             if file.extract:
-                if file.text:
+                if file.text is not None:
                     # Better write it to a temporary file, so we can
                     # get its hash.
                     tfile = Filename.temporary('', 'p3d_')
@@ -2060,12 +2994,14 @@ class Packager:
                     xextract = self.getFileSpec('extract', tfile, file.newName)
                     tfile.unlink()
 
+                    self.extracts.append((file.newName.lower(), xextract))
+
                 else:
-                    # The file data exists on disk already.
-                    xextract = self.getFileSpec('extract', file.filename, file.newName)
-                self.extracts.append((file.newName.lower(), xextract))
+                    # The file data exists on disk already; we'll
+                    # hash it later, along with the others.
+                    self.extractFiles.append((file.newName.lower(), file.filename, file.newName))
 
-            xcomponent = TiXmlElement('component')
+            xcomponent = XmlNode('component')
             xcomponent.SetAttribute('filename', file.newName)
             self.components.append(('c', file.newName.lower(), xcomponent))
 
@@ -2148,10 +3084,11 @@ class Packager:
                 self.requires.append(package)
                 for lowerName in package.targetFilenames.keys():
                     ext = Filename(lowerName).getExtension()
-                    if ext not in self.packager.nonuniqueExtensions:
+                    if ext not in self.packager.nonuniqueExtensionsSet:
                         self.skipFilenames[lowerName] = True
                 for moduleName, mdef in package.moduleNames.items():
                     self.skipModules[moduleName] = mdef
+                self.excludeSeq += 1
 
     # Packager constructor
     def __init__(self, platform = None):
@@ -2222,6 +3159,11 @@ class Packager:
         # This is where we cache the location of libraries.
         self.libraryCache = {}
 
+        # The true-case Filename (or None, if it doesn't exist) of
+        # each directory named in a search path variable so far.  See
+        # __addSearchPath().
+        self.trueCaseDirs = {}
+
         # The system PATH, for searching dll's and exe's.
         self.executablePath = DSearchPath()
 
@@ -2232,17 +3174,17 @@ class Packager:
             self.executablePath.appendDirectory(Filename.fromOsSpecific(dirname))
 
         # Now add the actual system search path.
-        if self.platform.startswith('win'):
+        if self.isWindows:
             self.addWindowsSearchPath(self.executablePath, "PATH")
 
         else:
-            if self.platform.startswith('osx'):
+            if self.isOsx:
                 self.addPosixSearchPath(self.executablePath, "DYLD_LIBRARY_PATH")
 
             self.addPosixSearchPath(self.executablePath, "LD_LIBRARY_PATH")
             self.addPosixSearchPath(self.executablePath, "PATH")
 
-            if self.platform.startswith('linux'):
+            if self.isLinux:
                 # It used to be okay to just add some common paths on Linux.
                 # But nowadays, each distribution has their own convention for
                 # where they put their libraries.  Instead, we query the ldconfig
@@ -2266,6 +3208,48 @@ class Packager:
         if os.uname()[1] == "pcbsd":
             self.executablePath.appendDirectory('/usr/PCBSD/local/lib')
 
+        # A map of lowercase basename to the list of directories on
+        # self.executablePath that contain a file by that name.  This
+        # is filled in the first time we need to resolve a library.
+        self.executablePathIndex = None
+        self.executablePathIndexSize = 0
+
+        # The dependencies read from each executable file so far
+        # in this run.  See Package.__cacheDependencies().
+        self.dependencyCache = {}
+
+        # The largest number of threads the packager may use for work
+        # that can run in parallel: reading executables for their
+        # dependencies, hashing files, listing directories and removing
+        # old files.  We only use threads if Panda has been compiled
+        # with true threading support.
+        self.packagerThreads = 1
+        if Thread.isTrueThreads():
+            try:
+                import multiprocessing
+                self.packagerThreads = multiprocessing.cpu_count()
+            except (ImportError, NotImplementedError):
+                pass
+
+        # Whether the pigz command is available for compressing
+        # packages, or None if we haven't tried it yet.
+        self.havePigz = None
+
+        # The zlib compression level (1-9) of the subfiles within a
+        # p3d file, and of the compressed .mf.pz file written for
+        # each package.  Lower values build faster but produce larger
+        # downloads.  Only zlib may be used here: it is the only
+        # compression that Multifile and the runtime can read.
+        self.p3dCompressionLevel = ConfigVariableInt('packager-p3d-compression-level', 6).getValue()
+        self.pzCompressionLevel = ConfigVariableInt('packager-pz-compression-level', 6).getValue()
+
+        # The amount of in-memory subfile data, in bytes, that may
+        # accumulate before it is flushed to the multifile being
+        # built.  This only bounds how much pending stream data is
+        # held in ram; the multifile compresses each subfile on its
+        # own, so it has no effect on compression.
+        self.multifileFlushBytes = ConfigVariableInt('packager-multifile-flush-size', 16 * 1024 * 1024).getValue()
+
         # Set this flag true to automatically add allow_python_dev to
         # any applications.
         self.allowPythonDev = False
@@ -2299,16 +3283,21 @@ class Packager:
 
         # Is this file system case-sensitive?
         self.caseSensitive = True
-        if self.platform.startswith('win'):
+        if self.isWindows:
             self.caseSensitive = False
-        elif self.platform.startswith('osx'):
+        elif self.isOsx:
             self.caseSensitive = False
 
         # Get the list of filename extensions that are recognized as
-        # image files.
+        # image files.  Several types may claim the same extension, so
+        # only the first mention of each is kept.
         self.imageExtensions = []
+        seen = set()
         for type in PNMFileTypeRegistry.getGlobalPtr().getTypes():
-            self.imageExtensions += type.getExtensions()
+            for ext in type.getExtensions():
+                if ext not in seen:
+                    seen.add(ext)
+                    self.imageExtensions.append(ext)
 
         # Other useful extensions.  The .pz extension is implicitly
         # stripped.
@@ -2329,9 +3318,9 @@ class Packager:
         self.nonuniqueExtensions = [ 'prc' ]
 
         # Files that represent an executable or shared library.
-        if self.platform.startswith('win'):
+        if self.isWindows:
             self.executableExtensions = [ 'dll', 'pyd', 'exe' ]
-        elif self.platform.startswith('osx'):
+        elif self.isOsx:
             self.executableExtensions = [ 'so', 'dylib' ]
         else:
             self.executableExtensions = [ 'so' ]
@@ -2339,16 +3328,16 @@ class Packager:
         # Files that represent a Windows "manifest" file.  These files
         # must be explicitly extracted to disk so the OS can find
         # them.
-        if self.platform.startswith('win'):
+        if self.isWindows:
             self.manifestExtensions = [ 'manifest' ]
         else:
             self.manifestExtensions = [ ]
 
         # Extensions that are automatically remapped by convention.
         self.remapExtensions = {}
-        if self.platform.startswith('win'):
+        if self.isWindows:
             pass
-        elif self.platform.startswith('osx'):
+        elif self.isOsx:
             self.remapExtensions = {
                 'dll' : 'dylib',
                 'pyd' : 'so',
@@ -2420,8 +3409,9 @@ class Packager:
             GlobPattern('ld-linux-*.so*'),
             ]
 
-        # A Loader for loading models.
-        self.loader = Loader.Loader(self)
+        # A Loader for loading models.  This isn't created until it is
+        # needed; see getLoader().
+        self.loader = None
         self.sfxManagerList = None
         self.musicManager = None
 
@@ -2431,10 +3421,33 @@ class Packager:
         # A table of all known packages by name.
         self.packages = {}
 
+        # The directories listed by dir() in the current package.  See
+        # __scanDirectory().
+        self.scannedDirs = {}
+
+        # The parsed root elements of the *.import.xml files read so
+        # far (or None if unreadable), keyed on the absolute pathname,
+        # along with the (mtime, size) of the file when it was read.
+        # See __readPackageImportDescFile().
+        self.importDescFiles = {}
+
         # A list of PackageEntry objects read from the contents.xml
         # file.
         self.contents = {}
 
+        # The keys of self.contents, in the order they were read from
+        # the file and then added.  See setContentsEntry().
+        self.contentsOrder = []
+
+    def setContentsEntry(self, pe):
+        """ Replaces or adds the indicated PackageEntry in the table
+        of contents. """
+
+        key = pe.getKey()
+        if key not in self.contents:
+            self.contentsOrder.append(key)
+        self.contents[key] = pe
+
     def loadLdconfigCache(self):
         """ On GNU/Linux, runs ldconfig -p to find out where all the
         libraries on the system are located.  Assumes that the platform
@@ -2483,12 +3496,66 @@ class Packager:
             filename.setFullpath(self.libraryCache[path].getFullpath())
             return True
 
+        if filename.isLocal() and not filename.getDirname() and \
+           self.executablePath.getNumDirectories() != 0:
+            # A plain basename; look it up in the directory index
+            # instead of testing each directory on the path in turn.
+            found = self.__findOnExecutablePath(filename)
+            if found:
+                filename.setFullpath(found.getFullpath())
+                self.libraryCache[path] = Filename(filename)
+                return True
+
+            # Not in the index, but the file may have appeared since
+            # the index was built, or may only be visible through the
+            # vfs; fall through to the full search.
+
         if filename.resolveFilename(self.executablePath):
             self.libraryCache[path] = Filename(filename)
             return True
 
         return False
 
+    def __findOnExecutablePath(self, filename):
+        """ Returns the first match for the indicated basename along
+        self.executablePath, or None if there is none.  The
+        directories are listed once, and the listing is then used to
+        find the candidate directories for each name.  Since the
+        listing is keyed on the lowercase name, each candidate is
+        checked to really exist.  The index is rebuilt if directories
+        have been added to the path since it was built. """
+
+        numDirectories = self.executablePath.getNumDirectories()
+        if self.executablePathIndex is None or \
+           self.executablePathIndexSize != numDirectories:
+            index = {}
+            for i in range(self.executablePath.getNumDirectories()):
+                dirname = Filename(self.executablePath.getDirectory(i))
+                try:
+                    names = os.listdir(dirname.toOsSpecific() or '.')
+                except OSError:
+                    continue
+                for name in names:
+                    index.setdefault(name.lower(), []).append(dirname)
+            self.executablePathIndex = index
+            self.executablePathIndexSize = numDirectories
+
+        for dirname in self.executablePathIndex.get(filename.getBasename().lower(), []):
+            match = Filename(dirname, filename)
+            if match.exists():
+                return match
+
+        return None
+
+    def getLoader(self):
+        """ Returns the Loader used for loading models, creating it
+        the first time it is needed.  Many packages never load a
+        model, and needn't pay for setting one up. """
+
+        if self.loader is None:
+            self.loader = Loader.Loader(self)
+        return self.loader
+
     def setPlatform(self, platform = None):
         """ Sets the platform that this Packager will compute for.  On
         OSX, this can be used to specify the particular architecture
@@ -2501,6 +3568,13 @@ class Packager:
 
         self.platform = platform or PandaSystem.getPlatform()
 
+        # These are consulted in many places, so we work them out once
+        # here rather than testing the platform string each time.
+        platformLower = self.platform.lower()
+        self.isWindows = platformLower.startswith('win')
+        self.isOsx = platformLower.startswith('osx')
+        self.isLinux = platformLower.startswith('linux')
+
         # OSX uses this "arch" string for the otool and lipo commands.
         self.arch = None
         if self.platform.startswith('osx_'):
@@ -2580,29 +3654,38 @@ class Packager:
         """ Expands $varname, interpreting as a Windows-style search
         path, and adds its contents to the indicated DSearchPath. """
 
-        path = ExecutionEnvironment.getEnvironmentVariable(varname)
-        if len(path) == 0:
-            if varname not in os.environ:
-                return
-            path = os.environ[varname]
-        for dirname in path.split(';'):
-            dirname = Filename.fromOsSpecific(dirname)
-            if dirname.makeTrueCase():
-                searchPath.appendDirectory(dirname)
+        self.__addSearchPath(searchPath, varname, ';')
 
     def addPosixSearchPath(self, searchPath, varname):
         """ Expands $varname, interpreting as a Posix-style search
         path, and adds its contents to the indicated DSearchPath. """
 
+        self.__addSearchPath(searchPath, varname, ':')
+
+    def __addSearchPath(self, searchPath, varname, separator):
+        """ Expands $varname, splits it on the indicated separator,
+        and adds each directory that exists to the indicated
+        DSearchPath.  The same directory often appears in several
+        variables, so each one is only checked on disk once. """
+
         path = ExecutionEnvironment.getEnvironmentVariable(varname)
         if len(path) == 0:
             if varname not in os.environ:
                 return
             path = os.environ[varname]
-        for dirname in path.split(':'):
-            dirname = Filename.fromOsSpecific(dirname)
-            if dirname.makeTrueCase():
-                searchPath.appendDirectory(dirname)
+        for dirname in path.split(separator):
+            if dirname in self.trueCaseDirs:
+                filename = self.trueCaseDirs[dirname]
+            else:
+                filename = Filename.fromOsSpecific(dirname)
+                if not filename.makeTrueCase():
+                    filename = None
+                self.trueCaseDirs[dirname] = filename
+            if filename is not None:
+                searchPath.appendDirectory(filename)
+
+        # The directory index may no longer match the path.
+        self.executablePathIndex = None
 
 
     def setup(self):
@@ -2611,6 +3694,37 @@ class Packager:
 
         self.knownExtensions = self.imageExtensions + self.modelExtensions + self.textExtensions + self.binaryExtensions + self.uncompressibleExtensions + self.unprocessedExtensions
 
+        # The extension lists above are tested against every file
+        # added, so make sets of them for quick lookups.  The lists
+        # themselves should not be modified after this point.
+        self.knownExtensionsSet = frozenset(self.knownExtensions)
+        self.textExtensionsSet = frozenset(self.textExtensions)
+        self.executableExtensionsSet = frozenset(self.executableExtensions)
+        self.extractExtensionsSet = frozenset(self.extractExtensions)
+        self.platformSpecificExtensionsSet = frozenset(self.platformSpecificExtensions)
+        self.unprocessedExtensionsSet = frozenset(self.unprocessedExtensions)
+        self.nonuniqueExtensionsSet = frozenset(self.nonuniqueExtensions)
+        self.uncompressedExtensionsSet = frozenset(self.uncompressibleExtensions + self.imageExtensions)
+
+        # Build fast lookup tables for the system exclude lists.  Glob
+        # patterns without any wildcard characters are really just
+        # filenames, so they go into the set as well.  The remaining
+        # plain case-sensitive globs are combined into a single
+        # regular expression; any others are left to be matched one
+        # at a time.
+        excludeSystemFiles = set(self.excludeSystemFiles)
+        excludeSystemGlobs = []
+        self.excludeSystemGlobsWild = []
+        for exclude in self.excludeSystemGlobs:
+            if not exclude.hasGlobCharacters():
+                excludeSystemFiles.add(exclude.getPattern())
+            elif exclude.getCaseSensitive() and not exclude.getNomatchChars():
+                excludeSystemGlobs.append(exclude.getPattern())
+            else:
+                self.excludeSystemGlobsWild.append(exclude)
+        self.excludeSystemFilesSet = frozenset(excludeSystemFiles)
+        self.excludeSystemGlobsRE = globsToRegex(excludeSystemGlobs)
+
         self.currentPackage = None
 
         if self.installDir:
@@ -2679,15 +3793,7 @@ class Packager:
         # We'll stuff all of the predefined functions, and the
         # predefined classes, in the global dictionary, so the pdef
         # file can reference them.
-
-        # By convention, the existence of a method of this class named
-        # do_foo(self) is sufficient to define a pdef method call
-        # foo().
-        for methodName in self.__class__.__dict__.keys():
-            if methodName.startswith('do_'):
-                name = methodName[3:]
-                c = func_closure(name)
-                globals[name] = c.generic_func
+        globals.update(self.__getPdefFunctions())
 
         globals['p3d'] = class_p3d
         globals['package'] = class_package
@@ -2701,7 +3807,7 @@ class Packager:
         # It appears that having a separate globals and locals
         # dictionary causes problems with resolving symbols within a
         # class scope.  So, we just use one dictionary, the globals.
-        execfile(packageDef.toOsSpecific(), globals)
+        exec self.__compilePackageDef(packageDef) in globals
 
         packages = []
 
@@ -2719,10 +3825,10 @@ class Packager:
                         solo = (class_solo in classDef.__bases__)
                         self.beginPackage(name, p3dApplication = p3dApplication,
                                           solo = solo)
-                        statements = classDef.__dict__.get('__statements', [])
-                        if not statements:
+                        classStatements = classDef.__dict__.get('__statements', [])
+                        if not classStatements:
                             self.notify.info("No files added to %s" % (name))
-                        for (lineno, stype, sname, args, kw) in statements:
+                        for (lineno, stype, sname, args, kw) in classStatements:
                             if stype == 'class':
                                 raise PackagerError, 'Nested classes not allowed'
                             self.__evalFunc(sname, args, kw)
@@ -2747,6 +3853,45 @@ class Packager:
 
         return packages
 
+    def __getPdefFunctions(self):
+        """ Returns a dictionary of the functions that may be called
+        from a pdef file, mapping each name to the function that
+        records the call.  By convention, the existence of a method of
+        this class (or of a base class) named do_foo(self) is
+        sufficient to define a pdef method call foo().  The dictionary
+        is built only once per class. """
+
+        cls = self.__class__
+        functions = self.pdefFunctions.get(cls, None)
+        if functions is None:
+            functions = {}
+            for methodName in dir(cls):
+                if methodName.startswith('do_'):
+                    name = methodName[3:]
+                    c = func_closure(name)
+                    functions[name] = c.generic_func
+            self.pdefFunctions[cls] = functions
+        return functions
+
+    def __compilePackageDef(self, packageDef):
+        """ Returns the compiled code for the named .pdef file.  The
+        code object is cached, keyed on the file's modification time
+        and size, so that a pdef file read more than once in the same
+        session is only compiled once.  It is still executed each
+        time, since it may do anything at all. """
+
+        pathname = packageDef.toOsSpecific()
+        st = os.stat(pathname)
+        key = (pathname, st.st_mtime, st.st_size)
+        code = self.pdefCodeCache.get(key, None)
+        if code is None:
+            source = open(pathname, 'rU').read()
+            if source and source[-1] != '\n':
+                source += '\n'
+            code = compile(source, pathname, 'exec', 0, True)
+            self.pdefCodeCache[key] = code
+        return code
+
     def __evalFunc(self, name, args, kw):
         """ This is called from readPackageDef(), above, to call the
         function do_name(*args, **kw), as extracted from the pdef
@@ -2762,25 +3907,16 @@ class Packager:
 
     def __expandTabs(self, line, tabWidth = 8):
         """ Expands tab characters in the line to 8 spaces. """
-        p = 0
-        while p < len(line):
-            if line[p] == '\t':
-                # Expand a tab.
-                nextStop = ((p + tabWidth) / tabWidth) * tabWidth
-                numSpaces = nextStop - p
-                line = line[:p] + ' ' * numSpaces + line[p + 1:]
-                p = nextStop
-            else:
-                p += 1
-
-        return line
+        return line.expandtabs(tabWidth)
 
     def __countLeadingWhitespace(self, line):
         """ Returns the number of leading whitespace characters in the
-        line. """
+        line, after tab expansion. """
 
-        line = self.__expandTabs(line)
-        return len(line) - len(line.lstrip())
+        # Only the leading whitespace needs expanding, not the whole
+        # line.
+        indent = line[:len(line) - len(line.lstrip())]
+        return len(self.__expandTabs(indent))
 
     def __stripLeadingWhitespace(self, line, whitespaceCount):
         """ Removes the indicated number of whitespace characters, but
@@ -2791,14 +3927,16 @@ class Packager:
         return line
 
     def __parseArgs(self, words, argList):
-        args = {}
+        """ Removes the trailing parameter=value words from the list
+        of words, and returns them as a dictionary.  The first word is
+        never treated as a parameter. """
 
-        while len(words) > 1:
-            arg = words[-1]
-            if '=' not in arg:
-                return args
+        args = {}
 
-            parameter, value = arg.split('=', 1)
+        i = len(words)
+        while i > 1 and '=' in words[i - 1]:
+            i -= 1
+            parameter, value = words[i].split('=', 1)
             parameter = parameter.strip()
             value = value.strip()
             if parameter not in argList:
@@ -2810,8 +3948,8 @@ class Packager:
 
             args[parameter] = value
 
-            del words[-1]
-
+        del words[i:]
+        return args
 
     def beginPackage(self, packageName, p3dApplication = False,
                      solo = False):
@@ -2824,6 +3962,7 @@ class Packager:
 
         package = self.Package(packageName, self)
         self.currentPackage = package
+        self.scannedDirs = {}
 
         package.p3dApplication = p3dApplication
         package.solo = solo
@@ -2876,7 +4015,10 @@ class Packager:
         # Look on the searchlist.
         for dirname in self.installSearch:
             package = self.__scanPackageDir(dirname, packageName, platform or self.platform, version, host, requires = requires)
-            if not package:
+            if not package and not platform:
+                # Also look for a platform-independent package.  (If a
+                # platform was given, this would be the same search
+                # again.)
                 package = self.__scanPackageDir(dirname, packageName, platform, version, host, requires = requires)
 
             if package and host and package.host != host:
@@ -2911,7 +4053,7 @@ class Packager:
         selected.
         """
 
-        packages = []
+        filenames = []
 
         if version:
             # A specific version package.
@@ -2946,12 +4088,17 @@ class Packager:
                 filelist = glob.glob(filename.toOsSpecific())
 
             for file in filelist:
-                package = self.__readPackageImportDescFile(Filename.fromOsSpecific(file))
-                packages.append(package)
-
-        self.__sortImportPackages(packages)
-        for package in packages:
-            if package and self.__packageIsValid(package, requires, platform):
+                filenames.append(Filename.fromOsSpecific(file))
+
+        # Reading an import desc file in full means finding all of the
+        # packages it requires, so the files are sorted on just the
+        # version in their root element, and then read only until a
+        # suitable one turns up.
+        self.__sortImportFilenames(filenames)
+        requiredPanda = self.__findRequiredPanda(requires)
+        for filename in filenames:
+            package = self.__readPackageImportDescFile(filename)
+            if package and self.__packageIsValid(package, requiredPanda, platform):
                 return package
 
         return None
@@ -2987,6 +4134,7 @@ class Packager:
         if packageInfo and not packageInfos:
             packageInfos = [packageInfo]
 
+        requiredPanda = self.__findRequiredPanda(requires)
         for packageInfo in packageInfos:
             if not packageInfo or not packageInfo.importDescFile:
                 continue
@@ -3004,37 +4152,50 @@ class Packager:
             if not package.readImportDescFile(filename):
                 continue
 
-            if self.__packageIsValid(package, requires, platform):
+            if self.__packageIsValid(package, requiredPanda, platform):
                 return package
 
         # Couldn't find a suitable package.
         return None
 
-    def __sortImportPackages(self, packages):
-        """ Given a list of Packages read from *.import.xml filenames,
-        sorts them in reverse order by version, so that the
-        highest-numbered versions appear first in the list. """
+    def __sortImportFilenames(self, filenames):
+        """ Given a list of *.import.xml filenames, sorts them in place
+        in reverse order by the package version each one names, so
+        that the highest-numbered versions appear first in the list.
+        Any files that can't be read go at the end. """
 
-        tuples = []
-        for package in packages:
-            version = self.__makeVersionTuple(package.version)
-            tuples.append((version, file))
-        tuples.sort(reverse = True)
+        def getKey(filename):
+            pathname = os.path.abspath(filename.toOsSpecific())
+            xpackage = None
+            try:
+                st = os.stat(pathname)
+                cached = self.importDescFiles.get(pathname, None)
+                if cached and cached[0] == (st.st_mtime, st.st_size):
+                    # We've already parsed the whole file.
+                    xpackage = cached[1]
+            except OSError:
+                return (False, )
+
+            if xpackage is not None:
+                if xpackage.element.tag != 'package':
+                    return (False, )
+                version = xpackage.Attribute('version')
+            else:
+                attrib = loadXmlRootAttributes(filename, 'package')
+                if attrib is None:
+                    return (False, )
+                version = attrib.get('version')
+            return (True, self.__makeVersionTuple(version))
 
-        return [t[1] for t in tuples]
+        filenames.sort(key = getKey, reverse = True)
 
     def __sortPackageInfos(self, packages):
         """ Given a list of PackageInfos retrieved from a Host, sorts
-        them in reverse order by version, so that the highest-numbered
-        versions appear first in the list. """
-
-        tuples = []
-        for package in packages:
-            version = self.__makeVersionTuple(package.packageVersion)
-            tuples.append((version, file))
-        tuples.sort(reverse = True)
+        them in place in reverse order by version, so that the
+        highest-numbered versions appear first in the list. """
 
-        return [t[1] for t in tuples]
+        packages.sort(key = lambda package: self.__makeVersionTuple(package.packageVersion),
+                      reverse = True)
 
     def __makeVersionTuple(self, version):
         """ Converts a version string into a tuple for sorting, by
@@ -3044,47 +4205,56 @@ class Packager:
         if not version:
             return ('',)
 
+        words = self.versionTuples.get(version, None)
+        if words is not None:
+            return words
+
+        # Each match is a run of non-digits, which may be empty,
+        # followed by a run of digits, which may also be empty.
         words = []
-        p = 0
-        while p < len(version):
-            # Scan to the first digit.
-            w = ''
-            while p < len(version) and version[p] not in string.digits:
-                w += version[p]
-                p += 1
-            words.append(w)
-
-            # Scan to the end of the string of digits.
-            w = ''
-            while p < len(version) and version[p] in string.digits:
-                w += version[p]
-                p += 1
-            if w:
-                words.append(int(w))
-
-        return tuple(words)
-
-    def __packageIsValid(self, package, requires, platform):
+        for nonDigits, digits in self.versionWordsRE.findall(version):
+            if not nonDigits and not digits:
+                # The empty match at the end of the string.
+                break
+            words.append(nonDigits)
+            if digits:
+                words.append(int(digits))
+
+        words = tuple(words)
+        self.versionTuples[version] = words
+        return words
+
+    def __findRequiredPanda(self, requires):
+        """ Returns the panda3d package named in (or required by) the
+        indicated list of already-required packages, or None.  This
+        is the only package __packageIsValid() checks against, so the
+        callers look it up once rather than once per candidate. """
+
+        if not requires:
+            return None
+        return self.__findPackageInRequires('panda3d', requires)
+
+    def __packageIsValid(self, package, requiredPanda, platform):
         """ Returns true if the package is valid, meaning it can be
         imported without conflicts with existing packages already
-        required (such as different versions of panda3d). """
+        required (such as different versions of panda3d).
+        requiredPanda is the result of __findRequiredPanda(). """
 
         if package.platform and package.platform != platform:
             # Incorrect platform.
             return False
 
-        if not requires:
-            # No other restrictions.
-            return True
-
         # Really, we only check the panda3d package.  The other
         # packages will list this as a dependency, and this is all
         # that matters.
 
-        panda1 = self.__findPackageInRequires('panda3d', [package] + package.requires)
-        panda2 = self.__findPackageInRequires('panda3d', requires)
+        panda2 = requiredPanda
+        if not panda2:
+            # No other restrictions.
+            return True
 
-        if not panda1 or not panda2:
+        panda1 = self.__findPackageInRequires('panda3d', [package] + package.requires)
+        if not panda1:
             return True
 
         if panda1.version == panda2.version:
@@ -3111,13 +4281,32 @@ class Packager:
 
     def __readPackageImportDescFile(self, filename):
         """ Reads the named xml file as a Package, and returns it if
-        valid, or None otherwise. """
+        valid, or None otherwise.  The parsed XML is remembered, keyed
+        on the file's absolute path, modification time and size, since
+        the same files are scanned again for each package that is
+        looked up, often through more than one install directory.
+        The Package itself is built anew each time, so that the
+        packages it requires are resolved against the current state
+        of the packager. """
+
+        pathname = os.path.abspath(filename.toOsSpecific())
+        try:
+            st = os.stat(pathname)
+        except OSError:
+            return None
 
-        package = self.Package('', self)
-        if package.readImportDescFile(filename):
-            return package
+        stamp = (st.st_mtime, st.st_size)
+        cached = self.importDescFiles.get(pathname, None)
+        if cached and cached[0] == stamp:
+            xpackage = cached[1]
+        else:
+            xpackage = loadXmlFile(filename)
+            self.importDescFiles[pathname] = (stamp, xpackage)
 
-        return None
+        package = self.Package('', self)
+        if not package.loadImportDescXml(xpackage):
+            return None
+        return package
 
     def do_setVer(self, value):
         """ Sets an explicit set_ver number for the package, as a tuple
@@ -3317,7 +4506,7 @@ class Packager:
         # extensions are automatically replaced with the appropriate
         # platform-specific extensions.
 
-        if self.platform.startswith('osx'):
+        if self.isOsx:
             # On Mac, we package up a P3DPython.app bundle.  This
             # includes specifications in the plist file to avoid
             # creating a dock icon and stuff.
@@ -3346,20 +4535,20 @@ class Packager:
             else:
                 self.do_config(p3dpython_name=p3dpythonName)
 
-            if self.platform.startswith('win'):
+            if self.isWindows:
                 self.do_file('p3dpython.exe', newName=p3dpythonName+'.exe')
             else:
                 self.do_file('p3dpython.exe', newName=p3dpythonName)
 
             # The "Windows" executable appends a 'w' to whatever name is used
             # above, unless an override name is explicitly specified.
-            if self.platform.startswith('win'):
+            if self.isWindows:
                 if p3dpythonwName is None:
                     p3dpythonwName = p3dpythonName+'w'
                 else:
                     self.do_config(p3dpythonw_name=p3dpythonwName)
 
-                if self.platform.startswith('win'):
+                if self.isWindows:
                     self.do_file('p3dpythonw.exe', newName=p3dpythonwName+'.exe')
                 else:
                     self.do_file('p3dpythonw.exe', newName=p3dpythonwName)
@@ -3504,6 +4693,11 @@ class Packager:
         files = []
         explicit = True
 
+        # Overlapping globs may name the same file more than once.
+        seenFiles = set()
+
+        remapExtensions = self.remapExtensions
+
         for filename in filenames:
             filename = Filename(filename)
 
@@ -3518,13 +4712,19 @@ class Packager:
                 if executable is None and ext == 'exe':
                     executable = True
 
-                newExt = self.remapExtensions.get(ext, None)
+                newExt = remapExtensions.get(ext, None)
                 if newExt is not None:
                     filename.setExtension(newExt)
 
-                thisFiles = glob.glob(filename.toOsSpecific())
-                if not thisFiles:
-                    thisFiles = [filename.toOsSpecific()]
+                osFilename = filename.toOsSpecific()
+                if glob.has_magic(osFilename):
+                    globbedFiles = glob.glob(osFilename)
+                    thisFiles = globbedFiles or [osFilename]
+                else:
+                    # A literal filename is added whether it exists or
+                    # not, so there's nothing to look up yet.
+                    globbedFiles = None
+                    thisFiles = [osFilename]
 
                 if newExt == 'dll' or (ext == 'dll' and newExt is None):
                     # Go through the dsoFilename interface on Windows,
@@ -3534,7 +4734,13 @@ class Packager:
                     dllFilename.setExtension('so')
                     dllFilename = Filename.dsoFilename(str(dllFilename))
                     if dllFilename != filename:
-                        thisFiles = glob.glob(filename.toOsSpecific())
+                        # The same glob as above; no need to scan the
+                        # directory again.
+                        thisFiles = globbedFiles
+                        if thisFiles is None:
+                            thisFiles = []
+                            if os.path.lexists(osFilename):
+                                thisFiles = [osFilename]
                         if not thisFiles:
                             # We have to resolve this filename to
                             # determine if it's a _d or not.
@@ -3545,7 +4751,10 @@ class Packager:
 
             if len(thisFiles) > 1:
                 explicit = False
-            files += thisFiles
+            for file in thisFiles:
+                if file not in seenFiles:
+                    seenFiles.add(file)
+                    files.append(file)
 
         prefix = ''
         if newDir is not None:
@@ -3565,14 +4774,14 @@ class Packager:
             if not newName:
                 newName = str(filenames[0])
 
+        addFile = self.currentPackage.addFile
         for filename in files:
             filename = Filename.fromOsSpecific(filename)
-            basename = filename.getBasename()
             name = newName
             if not name:
-                name = prefix + basename
+                name = prefix + filename.getBasename()
 
-            self.currentPackage.addFile(
+            addFile(
                 filename, newName = name, extract = extract,
                 explicit = explicit, executable = executable,
                 text = text, deleteTemp = deleteTemp,
@@ -3619,45 +4828,126 @@ class Packager:
         # Adding the directory to sys.path is a cheesy way to help the
         # modulefinder find it.
         sys.path.append(dirname.toOsSpecific())
+        self.__prefetchDirectories(dirname)
         self.__recurseDir(dirname, newDir, unprocessed = unprocessed)
 
+    def __prefetchDirectories(self, dirname):
+        """ Lists the whole directory hierarchy below dirname into
+        self.scannedDirs, ahead of __recurseDir(), if
+        self.packagerThreads allows more than one thread.  The
+        hierarchy is read a level at a time, and the directories of
+        each level are farmed out to a pool of threads;
+        vfs.scanDirectory() releases the interpreter lock while it
+        reads.  __recurseDir() still adds the files in order. """
+
+        numThreads = self.packagerThreads
+        if numThreads <= 1:
+            return
+
+        pool = None
+        try:
+            level = [dirname]
+            while level:
+                level = [d for d in level if str(d) not in self.scannedDirs]
+                if len(level) > 1:
+                    if pool is None:
+                        from multiprocessing.pool import ThreadPool
+                        pool = ThreadPool(numThreads)
+                    dirLists = pool.map(vfs.scanDirectory, level)
+                else:
+                    dirLists = map(vfs.scanDirectory, level)
+
+                nextLevel = []
+                for dirname, dirList in zip(level, dirLists):
+                    self.scannedDirs[str(dirname)] = dirList
+                    if dirList:
+                        for subfile in dirList:
+                            if subfile.isDirectory():
+                                nextLevel.append(subfile.getFilename())
+                level = nextLevel
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def __scanDirectory(self, dirname):
+        """ Returns vfs.scanDirectory(dirname), remembering the result
+        until the end of the current package, in case dir() is asked
+        for overlapping trees. """
+
+        key = str(dirname)
+        if key in self.scannedDirs:
+            return self.scannedDirs[key]
+
+        dirList = vfs.scanDirectory(dirname)
+        self.scannedDirs[key] = dirList
+        return dirList
+
     def __recurseDir(self, filename, newName, unprocessed = None, packageTree = None):
-        dirList = vfs.scanDirectory(filename)
-        if dirList:
+        """ Adds the indicated file, or all of the files with known
+        extensions in the indicated directory hierarchy, to the current
+        package.  The hierarchy is walked depth-first with an explicit
+        stack, rather than by recursion, so that a very deep tree
+        can't exhaust the Python stack. """
+
+        # Each entry is (filename, newName, isDirectory); isDirectory
+        # is None if we don't know yet.  Entries are pushed in reverse,
+        # so they come off the stack in directory order.
+        stack = [(filename, newName, None)]
+        while stack:
+            filename, newName, isDirectory = stack.pop()
+            dirList = None
+            if isDirectory is not False:
+                # No need to try scanning a plain file.
+                dirList = self.__scanDirectory(filename)
+
+            if not dirList:
+                # It's a file name.  Add it.
+                self.__addDirFile(filename, newName, unprocessed = unprocessed)
+                continue
+
             # It's a directory name.  Recurse.
             prefix = newName
             if prefix and prefix[-1] != '/':
                 prefix += '/'
 
-            # First check if this is a Python package tree.  If so, add it
-            # implicitly as a module.
+            entries = []
             for subfile in dirList:
                 filename = subfile.getFilename()
-                if filename.getBasename() == '__init__.py':
+                basename = filename.getBasename()
+
+                # Check if this is a Python package tree.  If so, add it
+                # implicitly as a module.  Nothing within the directory
+                # has been added yet, since that waits until its entries
+                # come off the stack.
+                if basename == '__init__.py':
                     moduleName = newName.replace("/", ".")
                     self.addModule([moduleName], filename=filename)
 
-            for subfile in dirList:
-                filename = subfile.getFilename()
-                self.__recurseDir(filename, prefix + filename.getBasename(),
-                                  unprocessed = unprocessed)
-            return
+                entries.append((filename, prefix + basename,
+                                bool(subfile.isDirectory())))
+            entries.reverse()
+            stack += entries
+
+    def __addDirFile(self, filename, newName, unprocessed = None):
+        """ Adds the indicated file, found by __recurseDir(), to the
+        current package, if it has a known extension. """
 
-        # It's a file name.  Add it.
         ext = filename.getExtension()
         if ext == 'py':
             self.currentPackage.addFile(filename, newName = newName,
                                         explicit = False, unprocessed = unprocessed)
         else:
             if ext == 'pz':
-                # Strip off an implicit .pz extension.
-                newFilename = Filename(filename)
-                newFilename.setExtension('')
-                newFilename = Filename(str(newFilename))
-                ext = newFilename.getExtension()
-
-            if ext in self.knownExtensions:
-                if ext in self.textExtensions:
+                # Strip off an implicit .pz extension.  We just need
+                # the extension before it, so there's no need to build
+                # a new Filename.
+                basename, dot, ext = filename.getBasename()[:-3].rpartition('.')
+                if not dot:
+                    ext = ''
+
+            if ext in self.knownExtensionsSet:
+                if ext in self.textExtensionsSet:
                     filename.setText()
                 else:
                     filename.setBinary()
@@ -3677,39 +4967,73 @@ class Packager:
         self.maxAge = 0
         self.contentsSeq = SeqValue()
         self.contents = {}
+        self.contentsOrder = []
         self.contentsChanged = False
 
         if not self.allowPackages:
             # Don't bother.
             return
 
+        try:
+            from xml.etree import cElementTree as ElementTree
+        except ImportError:
+            from xml.etree import ElementTree
+
+        # The file is parsed incrementally, one toplevel element at
+        # a time, so that a large contents.xml file need not be held
+        # in memory all at once.
+        host = self.host
         contentsFilename = Filename(self.installDir, 'contents.xml')
-        doc = TiXmlDocument(contentsFilename.toOsSpecific())
-        if not doc.LoadFile():
-            # Couldn't read file.
-            return
+        try:
+            events = ElementTree.iterparse(contentsFilename.toOsSpecific(),
+                                           events = ('start', 'end'))
+            root = None
+            depth = 0
+            foundHost = False
+            for event, elem in events:
+                if event == 'start':
+                    depth += 1
+                    if depth == 1:
+                        if elem.tag != 'contents':
+                            break
+                        root = elem
+                        xcontents = XmlElement(elem)
+                        maxAge = xcontents.Attribute('max_age')
+                        if maxAge:
+                            self.maxAge = int(maxAge)
+
+                        self.contentsSeq.loadXml(xcontents)
+                    continue
+
+                depth -= 1
+                if depth != 1:
+                    continue
 
-        xcontents = doc.FirstChildElement('contents')
-        if xcontents:
-            maxAge = xcontents.Attribute('max_age')
-            if maxAge:
-                self.maxAge = int(maxAge)
+                if elem.tag == 'host' and not foundHost:
+                    foundHost = True
+                    he = self.HostEntry()
+                    he.loadXml(XmlElement(elem), self)
+                    self.hosts[he.url] = he
+                    self.host = he.url
 
-            self.contentsSeq.loadXml(xcontents)
+                elif elem.tag == 'package':
+                    pe = self.PackageEntry()
+                    pe.loadXml(XmlElement(elem))
+                    self.setContentsEntry(pe)
 
-            xhost = xcontents.FirstChildElement('host')
-            if xhost:
-                he = self.HostEntry()
-                he.loadXml(xhost, self)
-                self.hosts[he.url] = he
-                self.host = he.url
+                # We're done with this element; free it.
+                root.clear()
 
-            xpackage = xcontents.FirstChildElement('package')
-            while xpackage:
-                pe = self.PackageEntry()
-                pe.loadXml(xpackage)
-                self.contents[pe.getKey()] = pe
-                xpackage = xpackage.NextSiblingElement('package')
+        except (IOError, SyntaxError):
+            # Couldn't read file.  Discard anything we may have
+            # picked up from it before the error.
+            self.host = host
+            self.hosts = {}
+            self.addHost(self.host)
+            self.maxAge = 0
+            self.contentsSeq = SeqValue()
+            self.contents = {}
+            self.contentsOrder = []
 
     def writeContentsFile(self):
         """ Rewrites the contents.xml file at the end of
@@ -3719,32 +5043,57 @@ class Packager:
             # No need to rewrite.
             return
 
-        contentsFilename = Filename(self.installDir, 'contents.xml')
-        doc = TiXmlDocument(contentsFilename.toOsSpecific())
-        decl = TiXmlDeclaration("1.0", "utf-8", "")
-        doc.InsertEndChild(decl)
-
-        xcontents = TiXmlElement('contents')
+        # The file is written out directly, one element at a time,
+        # rather than by building a TiXmlDocument in memory first.
+        xcontents = XmlAttributes()
         if self.maxAge:
             xcontents.SetAttribute('max_age', str(self.maxAge))
 
         self.contentsSeq += 1
         self.contentsSeq.storeXml(xcontents)
 
+        he = None
         if self.host:
             he = self.hosts.get(self.host, None)
-            if he:
-                xhost = he.makeXml(packager = self)
-                xcontents.InsertEndChild(xhost)
 
-        contents = self.contents.items()
-        contents.sort()
-        for key, pe in contents:
-            xpackage = pe.makeXml()
-            xcontents.InsertEndChild(xpackage)
+        # The file was written in sorted order, so the keys read from
+        # it are already sorted, followed by the few that have been
+        # added since; sorting that is nearly free.
+        self.contentsOrder.sort()
+        contents = [(key, self.contents[key]) for key in self.contentsOrder]
+
+        # Write the file to a temporary filename, then atomically move
+        # it to its actual filename, so that a client never sees a
+        # partially-written contents.xml.
+        contentsFilename = Filename(self.installDir, 'contents.xml')
+        tfile = Filename.temporary(self.installDir.cStr(), 'contents.', '.xml')
 
-        doc.InsertEndChild(xcontents)
-        doc.SaveFile()
+        # The many small writes below are gathered up by the file's
+        # buffer; a large one means few write() calls to the OS.
+        out = open(tfile.toOsSpecific(), 'wb', 1024 * 1024)
+        try:
+            out.write('<?xml version="1.0" encoding="utf-8" ?>\n')
+            out.write('<contents')
+            xcontents.write(out)
+            if not he and not contents:
+                out.write(' />\n')
+            else:
+                out.write('>\n')
+                if he:
+                    he.writeXml(out, packager = self)
+                for key, pe in contents:
+                    pe.writeXml(out)
+                out.write('</contents>\n')
+        except:
+            out.close()
+            tfile.unlink()
+            raise
+
+        out.close()
+        if not tfile.renameTo(contentsFilename):
+            tfile.unlink()
+            message = 'Unable to write %s' % (contentsFilename)
+            raise PackagerError, message
 
 
 # The following class and function definitions represent a few sneaky
@@ -3783,8 +5132,12 @@ class metaclass_def(type):
 
             # Store the class name on a statements list in that
             # context, so we can later resolve the class names in
-            # the order they appeared in the file.
-            mdict.setdefault('__statements', []).append((lineno, 'class', name, None, None))
+            # the order they appeared in the file.  (setdefault()
+            # would build a new empty list on every call.)
+            statements = mdict.get('__statements', None)
+            if statements is None:
+                statements = mdict['__statements'] = []
+            statements.append((lineno, 'class', name, None, None))
 
         return type.__new__(self, name, bases, dict)
 
@@ -3828,4 +5181,7 @@ class func_closure:
 
         # Store the function on a statements list in that context, so we
         # can later walk through the function calls for each class.
-        cldict.setdefault('__statements', []).append((lineno, 'func', self.name, args, kw))
+        statements = cldict.get('__statements', None)
+        if statements is None:
+            statements = cldict['__statements'] = []
+        statements.append((lineno, 'func', self.name, args, kw))
@@ -592,6 +592,10 @@ class Freezer:
         # or dll's; those are always stored with compiled code.
         self.storePythonSource = False
 
+        # addToMultifile() flushes the Multifile whenever the compiled
+        # code added since the last flush reaches this many bytes.
+        self.multifileFlushBytes = 16 * 1024 * 1024
+
         # This list will be filled in by generateCode() or
         # addToMultifile().  It contains a list of all the extension
         # modules that were discovered, which have not been added to
@@ -599,11 +603,24 @@ class Freezer:
         # (moduleName, filename).
         self.extras = []
 
+        # This is set true by addToMultifile() if it removed or
+        # replaced any subfiles that were already in the Multifile.
+        # The Multifile must then be repacked to reclaim the space
+        # they occupied.
+        self.removedSubfiles = False
+
         # End of public interface.  These remaining members should not
         # be directly manipulated by callers.
         self.previousModules = {}
         self.modules = {}
 
+        # The in-memory streams added to the Multifile by
+        # addToMultifile() that have not yet been flushed.  The
+        # Multifile reads each stream only when it is flushed, so they
+        # must be kept alive until then.
+        self.pendingStreams = []
+        self.pendingStreamBytes = 0
+
         if previous:
             self.previousModules = dict(previous.modules)
             self.modules = dict(previous.modules)
@@ -1068,8 +1085,31 @@ class Freezer:
                    marshal.dumps(code)
 
             stream = StringStream(data)
+            self.__noteReplacedSubfile(multifile, filename)
             multifile.addSubfile(filename, stream, compressionLevel)
+            self.__addPendingStream(multifile, stream)
+
+    def __addPendingStream(self, multifile, stream):
+        """ Records a stream just added to the multifile, flushing
+        the multifile once the pending streams hold
+        self.multifileFlushBytes. """
+        self.pendingStreams.append(stream)
+        self.pendingStreamBytes += stream.getDataSize()
+        if self.pendingStreamBytes >= self.multifileFlushBytes:
+            self.__flushPendingStreams(multifile)
+
+    def __noteReplacedSubfile(self, multifile, filename):
+        """ Records whether adding the named subfile will replace
+        one already in the multifile. """
+        if multifile.findSubfile(filename) >= 0:
+            self.removedSubfiles = True
+
+    def __flushPendingStreams(self, multifile):
+        """ Writes out the subfiles added since the last flush. """
+        if self.pendingStreams:
             multifile.flush()
+            self.pendingStreams = []
+            self.pendingStreamBytes = 0
 
     def __addPythonDirs(self, multifile, moduleDirs, dirnames, compressionLevel):
         """ Adds all of the names on dirnames as a module directory. """
@@ -1088,7 +1128,7 @@ class Freezer:
                 stream = StringStream('')
                 if multifile.findSubfile(filename) < 0:
                     multifile.addSubfile(filename, stream, 0)
-                    multifile.flush()
+                    self.__addPendingStream(multifile, stream)
             else:
                 if __debug__:
                     filename += '.pyc'
@@ -1125,11 +1165,17 @@ class Freezer:
             moduleDirs[moduleName] = True
 
             # Ensure we don't have an implicit filename from above.
-            multifile.removeSubfile(filename + '.py')
+            # A subfile must be flushed before it can be removed.
+            implicitNames = [filename + '.py']
             if __debug__:
-                multifile.removeSubfile(filename + '.pyc')
+                implicitNames.append(filename + '.pyc')
             else:
-                multifile.removeSubfile(filename + '.pyo')
+                implicitNames.append(filename + '.pyo')
+            for implicitName in implicitNames:
+                if multifile.findSubfile(implicitName) >= 0:
+                    self.__flushPendingStreams(multifile)
+                    multifile.removeSubfile(implicitName)
+                    self.removedSubfiles = True
 
         # Attempt to add the original source file if we can.
         sourceFilename = None
@@ -1142,6 +1188,7 @@ class Freezer:
         if self.storePythonSource:
             if sourceFilename and sourceFilename.exists():
                 filename += '.py'
+                self.__noteReplacedSubfile(multifile, filename)
                 multifile.addSubfile(filename, sourceFilename, compressionLevel)
                 return
 
@@ -1183,11 +1230,20 @@ class Freezer:
         python code into the indicated Multifile.  Additional
         extension modules are listed in self.extras.  """
 
+        # The compiled modules are written out in batches of
+        # self.multifileFlushBytes, rather than flushing the Multifile
+        # after each one.  The Multifile doesn't take ownership of the
+        # streams, so whatever is still pending must be flushed before
+        # we let go of them, even if something went wrong.
+        self.removedSubfiles = False
         moduleDirs = {}
-        for moduleName, mdef in self.getModuleDefs():
-            if not mdef.exclude:
-                self.__addPythonFile(multifile, moduleDirs, moduleName, mdef,
-                                     compressionLevel)
+        try:
+            for moduleName, mdef in self.getModuleDefs():
+                if not mdef.exclude:
+                    self.__addPythonFile(multifile, moduleDirs, moduleName, mdef,
+                                         compressionLevel)
+        finally:
+            self.__flushPendingStreams(multifile)
 
     def writeMultifile(self, mfname):
         """ After a call to done(), this stores all of the accumulated